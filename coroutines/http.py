@@ -7,127 +7,91 @@ API modelled around the built-in "http.client" package
 from http.client import (
     UnknownTransferEncoding, UnknownProtocol, HTTPException)
 import http.client
-import email.parser
+from email.errors import MissingHeaderBodySeparatorDefect
 import net
-from asyncio import Future
+import asyncio
+from collections import deque
+import re
+import ssl
+import socket
+import sys
+import traceback
+from functools import partial
+from misc import Context
+from .socket import Socket, Ssl
 
 class HTTPConnection:
     def __init__(self, sock):
         self.sock = sock
+        self.reader = Reader(sock)
+        self._buffer = bytearray()
+        self._methods = deque()  # Requests awaiting responses
     
-    async def putrequest(self, method, target):
-        await self.sock.sendall(method.encode())
-        await self.sock.sendall(b" ")
+    def putrequest(self, method, target):
+        """Start a request
+        
+        The request line and headers are buffered until endheaders() is
+        called."""
+        
         if isinstance(target, str):
             target = target.encode("ascii")
-        for c in target:
-            if c <= ord(b" "):
-                await self.sock.sendall("%{:02X}".format(c).encode("ascii"))
-            else:
-                await self.sock.sendall(bytes((c,)))
-        
-        await self.sock.sendall(b" HTTP/1.1\r\n")
+        target = UNSAFE_TARGET.sub(_escape_char, target)
+        self._methods.append(method)
+        self._buffer.extend(method.encode())
+        self._buffer.extend(b" ")
+        self._buffer.extend(target)
+        self._buffer.extend(b" HTTP/1.1\r\n")
     
     AGENT = "coroutines.http (Vadmium)"
     
-    async def endheaders(self):
-        await self.sock.sendall(b"\r\n")
+    # Bodies up to this size are sent in the same write as the header
+    BODY_COALESCE_LIMIT = 0x4000
     
-    async def putheader(self, name, value):
-        await self.sock.sendall(name.encode("ascii"))
-        await self.sock.sendall(b": ")
-        await self.sock.sendall(value.encode("ascii"))
-        await self.sock.sendall(b"\r\n")
+    async def endheaders(self, message_body=None):
+        """Send the buffered request line and headers
+        
+        An optional bytes-like "message_body" is sent after the headers,
+        copied into the same write if it is small, otherwise with a
+        scatter-gather write."""
+        
+        self._buffer.extend(b"\r\n")
+        [buffer, self._buffer] = (self._buffer, bytearray())
+        if message_body is None:
+            await self.sock.sendall(buffer)
+        elif len(message_body) <= self.BODY_COALESCE_LIMIT:
+            buffer.extend(message_body)
+            await self.sock.sendall(buffer)
+        else:
+            await self.sock.sendall_many((buffer, message_body))
+    
+    def putheader(self, name, value):
+        self._buffer.extend(name.encode("ascii"))
+        self._buffer.extend(b": ")
+        self._buffer.extend(value.encode("ascii"))
+        self._buffer.extend(b"\r\n")
     
     async def getresponse(self):
-        parser = Parser(self.sock)
-        # else: parser.new_line()
-        await parser.next_char()
-        
-        #~ try:
-        if True:
-            #~ # if response does not begin "HTTP/n.n 999 ", assume HTTP/0.9
-            #~ # simple-response
-            
-            try:
-                pre_space = await parser.space()
-            except ExcessError as e:
-                raise BadStatusLine(e.data)
-            if parser.c == b"\n":
-                raise BadStatusLine(pre_space + parser.c)
-            
-            pattern = b"HTTP/"
-            for (i, p) in enumerate(pattern):
-                if i:
-                    await parser.next_char()
-                if not parser.c or ord(parser.c) != p:
-                    raise BadStatusLine(pre_space + pattern[:i] + parser.c)
-            
-            major = bytearray()
-            for _ in range(parser.NUMBER_LIMIT):
-                await parser.next_char()
-                if parser.c == b".":
-                    break
-                major.extend(parser.c)
-                if not parser.c.isdigit():
-                    raise BadStatusLine(pre_space + pattern + major)
-            else:
-                raise BadStatusLine(pre_space + pattern + major)
-            
-            minor = bytearray()
-            for _ in range(parser.NUMBER_LIMIT):
-                await parser.next_char()
-                if not parser.c.isdigit():
-                    break
-                minor.extend(parser.c)
-            else:
-                raise BadStatusLine(pre_space + pattern + major + b"." +
-                    minor)
-            
-            mid_space = bytearray()
-            for i in range(parser.TOKEN_LIMIT):
-                if i:
-                    await parser.next_char()
-                if not parser.c or parser.c.isspace():
-                    break
-                mid_space.extend(parser.c)
-            try:
-                space = await parser.space()
-            except ExcessError as e:
-                raise BadStatusLine(pre_space + pattern + major + b"." +
-                    minor + mid_space + e.data)
-            mid_space.extend(space)
-            if parser.c == b"\n":
-                raise BadStatusLine(pre_space + pattern + major + b"." +
-                    minor + mid_space + parser.c)
-            
-            status = bytearray()
-            for i in range(3):
-                if i:
-                    await parser.next_char()
-                status.extend(parser.c)
-                if not parser.c.isdigit():
-                    raise BadStatusLine(pre_space + pattern + major + b"." +
-                        minor + mid_space + status)
-        
-        if int(major) != 1:
-            raise UnknownProtocol("HTTP/{}".format(major))
+        """Read the response to the oldest request without one
         
-        await parser.next_char()
-        await parser.space()
+        Several requests may be sent before reading their responses, but
+        each response must be read to the end before the next one."""
         
-        reason = bytearray()
-        for _ in range(400):
-            current = parser.c
-            reason.extend(current)
-            await parser.next_char()
-            if current in b"\n" and not parser.at_lws():  # Including EOF
+        parser = Parser(self.reader)
+        while True:
+            [version, status, reason] = await parser.status_line()
+            msg = await parser.headers()
+            # Skip interim responses such as "100 Continue"
+            if not 100 <= int(status) < 200 or int(status) == 101:
                 break
-        else:
-            raise ExcessError("Status reason of 400 or more characters")
-        reason = reason.rstrip()
-        
-        msg = await parser.headers()
+        method = self._methods.popleft() if self._methods else None
+        response = self._body(method, status, reason, msg)
+        response.version = version
+        return response
+    
+    def _body(self, method, status, reason, msg):
+        if (method == "HEAD" or
+        int(status) in {http.client.NO_CONTENT, http.client.NOT_MODIFIED}):
+            return _LengthResponse(status, reason, msg, self.reader, "0", ())
         
         encodings = net.header_list(msg, "Transfer-Encoding")
         encoding = next(encodings, None)
@@ -135,10 +99,10 @@ class HTTPConnection:
             lengths = net.header_list(msg, "Content-Length")
             length = next(lengths, None)
             if length is None:
-                return _EofResponse(status, reason, msg, self.sock)
+                return _EofResponse(status, reason, msg, self.reader)
             else:
                 return _LengthResponse(status, reason, msg,
-                    self.sock, length, lengths)
+                    self.reader, length, lengths)
         
         # TODO: check for "identity"
         encodings = next(encodings, None)
@@ -146,7 +110,10 @@ class HTTPConnection:
             raise UnknownTransferEncoding("Not chunked transfer encoding")
         del msg["Transfer-Encoding"]
         
-        return _ChunkedResponse(status, reason, msg, self.sock)
+        return _ChunkedResponse(status, reason, msg, self.reader)
+
+def _escape_char(match):
+    return "%{:02X}".format(ord(match.group())).encode("ascii")
 
 class HTTPResponse:
     def __init__(self, status, reason, msg):
@@ -155,149 +122,840 @@ class HTTPResponse:
         self.msg = msg
 
 class _EofResponse(HTTPResponse):
-    def __init__(self, status, reason, msg, sock):
+    def __init__(self, status, reason, msg, reader):
         HTTPResponse.__init__(self, status, reason, msg)
-        self.sock = sock
+        self.reader = reader
     
     def read(self, amt):
-        return self.sock.recv(amt)
+        return self.reader.read(amt)
+    
+    def readinto(self, b):
+        return self.reader.readinto(b)
 
-class _LengthResponse(HTTPResponse):
-    def __init__(self, status, reason, msg, sock, length, lengths):
-        HTTPResponse.__init__(self, status, reason, msg)
-        self.sock = sock
-        self.size = int(length)
+class _LengthBody:
+    """Reads a body of a given length, for requests or responses"""
+    
+    def __init__(self, reader, length, lengths):
+        self.reader = reader
+        self.size = _content_length(length)
         for dupe in lengths:
-            if int(dupe) != self.size:
+            if _content_length(dupe) != self.size:
                 raise HTTPException("Conflicting Content-Length values")
     
     async def read(self, amt):
-        data = await self.sock.recv(min(self.size, amt))
+        if not self.size or not amt:
+            return b""
+        data = await self.reader.read(min(self.size, amt))
+        if not data:
+            raise http.client.IncompleteRead(b"", self.size)
         self.size -= len(data)
         return data
+    
+    async def readinto(self, b):
+        if not self.size:
+            return 0
+        with memoryview(b) as view, view.cast("B") as bytes:
+            if not bytes:
+                return 0
+            n = await self.reader.readinto(bytes[:self.size])
+        if not n:
+            raise http.client.IncompleteRead(b"", self.size)
+        self.size -= n
+        return n
 
-class _ChunkedResponse(HTTPResponse):
-    def __init__(self, status, reason, msg, sock):
-        HTTPResponse.__init__(self, status, reason, msg)
-        self.sock = sock
-        self.chunk_read = None
-        sock.loop.create_task(self.Chunks())
-        self.size = None
+def _content_length(value):
+    if not CONTENT_LENGTH.fullmatch(value):
+        raise HTTPException("Invalid Content-Length {!r}".format(value))
+    return int(value)
+
+class _ChunkedBody:
+    """Decodes the chunked transfer coding as the body is read
+    
+    Once the body has been read to the end, the "trailers" attribute holds
+    any trailer fields."""
+    
+    CHUNK_LIMIT = 30000
+    
+    def __init__(self, reader):
+        self.reader = reader
+        self.size = 0  # Remaining in current chunk; None at end of body
+        self.chunks = 0
+        self.trailers = None
     
     async def read(self, amt):
-        if not self.size:
-            self.next_size = Future(loop=self.sock.loop)
-            if self.chunk_read:
-                self.chunk_read.set_result(None)
-            try:
-                [self.size, self.chunk_read] = await self.next_size
-            except EOFError:
-                return b""
-        data = await self.sock.recv(min(self.size, amt))
-        self.size -= len(data)
-        return data
+        """Read up to "amt" bytes, possibly from several chunks
+        
+        Only waits to receive data if nothing has been read yet."""
+        
+        data = bytearray()
+        while len(data) < amt and (not data or self._ready()):
+            if not await self._next_chunk(data):
+                break
+            chunk = await self.reader.read(min(self.size, amt - len(data)))
+            if not chunk:
+                raise http.client.IncompleteRead(bytes(data), self.size)
+            self.size -= len(chunk)
+            data.extend(chunk)
+        return bytes(data)
     
-    async def Chunks(self):
-        """
-        Generator that returns chunk length
-        """
-        
-        for _ in range(30000):
-            parser = Parser(self.sock)
-            await parser.next_char()
-            if parser.c == b"\r":
-                await parser.next_char()
-            if parser.c == b"\n":
-                await parser.next_char()
-            await parser.space()
-            
-            size = 0
-            for _ in range(30):
-                try:
-                    digit = int(parser.c, 16)
-                except ValueError:
+    async def readinto(self, b):
+        with memoryview(b) as view, view.cast("B") as bytes:
+            n = 0
+            while n < len(bytes) and (not n or self._ready()):
+                if not await self._next_chunk(bytes[:n]):
                     break
-                size = size * 16 + digit
-                await parser.next_char()
-            else:
-                raise ExcessError("Chunk size of 30 or more digits")
-            
-            i = 0
-            while parser.c not in b"\n":  # Including EOF
-                i += 1
-                if i >= 3000:
-                    raise ExcessError("Line of 3000 or more characters")
-                await parser.next_char()
-            
-            if not size:
+                received = await self.reader.readinto(
+                    bytes[n:n + self.size])
+                if not received:
+                    raise http.client.IncompleteRead(bytes[:n].tobytes(),
+                        self.size)
+                self.size -= received
+                n += received
+        return n
+    
+    def _ready(self):
+        """Check if more of the body can be decoded without receiving"""
+        buffer = self.reader.buffer
+        if self.size is None:
+            return False
+        if self.size:
+            return bool(buffer)
+        # Need the terminator of the previous chunk and the next size line
+        start = 0
+        if self.chunks:
+            start = buffer.find(b"\n") + 1
+            if not start:
+                return False
+        end = buffer.find(b"\n", start)
+        if end < 0:
+            return False
+        size = CHUNK_SIZE.match(buffer, start).group(1)
+        if not size or size.strip(b"0"):
+            return True
+        # The last chunk also needs the complete trailer section
+        return TRAILER_END.search(buffer, end) is not None
+    
+    async def _next_chunk(self, partial):
+        """Returns False at the end of the body
+        
+        The "partial" data already read is included in IncompleteRead if
+        the body is cut short."""
+        
+        if self.size is None:
+            return False
+        if self.size:
+            return True
+        
+        line = await self.reader.readline(Parser.LINE_LIMIT)
+        if self.chunks and line in {b"\r\n", b"\n"}:
+            # Terminator of previous chunk's data
+            line = await self.reader.readline(Parser.LINE_LIMIT)
+        if not line.endswith(b"\n"):
+            raise http.client.IncompleteRead(bytes(partial))
+        size = CHUNK_SIZE.match(line).group(1)
+        if not size:
+            raise HTTPException("Invalid chunk size line {!r}".format(line))
+        if len(size) >= 30:
+            raise ExcessError("Chunk size of 30 or more digits")
+        size = int(size, 16)
+        if not size:
+            # Finish with the trailer before the connection can be reused
+            self.trailers = await Parser(self.reader).headers()
+            self.size = None
+            return False
+        self.chunks += 1
+        if self.chunks >= self.CHUNK_LIMIT:
+            raise ExcessError("{} or more chunks".format(self.CHUNK_LIMIT))
+        self.size = size
+        return True
+
+class _LengthResponse(_LengthBody, HTTPResponse):
+    def __init__(self, status, reason, msg, reader, length, lengths):
+        HTTPResponse.__init__(self, status, reason, msg)
+        _LengthBody.__init__(self, reader, length, lengths)
+
+class _ChunkedResponse(_ChunkedBody, HTTPResponse):
+    def __init__(self, status, reason, msg, reader):
+        HTTPResponse.__init__(self, status, reason, msg)
+        _ChunkedBody.__init__(self, reader)
+
+class AsyncClient(Context):
+    """HTTP client keeping persistent connections to multiple hosts
+    
+    with AsyncClient(loop=loop) as client:
+        with await client.get("http://example/") as response:
+            while True:
+                data = await response.read(0x10000)
+                if not data:
+                    break
+                ...
+    
+    Connections are kept per scheme, host name and port. Up to
+    "max_per_host" requests to each host proceed at once; further requests
+    wait. A connection is reused once its response has been read to the
+    end, unless either side specified "Connection: close". Closing a
+    response early closes its connection. Host names are resolved with the
+    C-ares library.
+    """
+    
+    PORTS = {"http": 80, "https": 443}
+    
+    def __init__(self, *, loop, max_per_host=6, ssl_context=None,
+            message=None):
+        self.loop = loop
+        self.max_per_host = max_per_host
+        self.ssl_context = ssl_context
+        self.message = message
+        self._idle = dict()  # {(scheme, host, port): [HTTPConnection, ...]}
+        self._limits = dict()  # {(scheme, host, port): Semaphore}
+    
+    def get(self, url, **kw):
+        return self.request("GET", url, **kw)
+    
+    async def request(self, method, url, body=None, headers=()):
+        """Send a request and return a ClientResponse once the response
+        header is received"""
+        
+        url = net.url_port(url, "http", self.PORTS)
+        key = (url["scheme"], url["hostname"], url["port"])
+        [target, _, _] = url["path"].partition("#")  # Fragment not sent
+        target = target or "/"
+        headers = list(dict(headers).items())
+        names = {name.lower() for [name, _] in headers}
+        if "host" not in names:
+            port = url["port"]
+            if port == self.PORTS[url["scheme"]]:
+                port = None
+            headers.append(("Host", net.format_addr((url["hostname"], port))))
+        if "user-agent" not in names:
+            headers.append(("User-Agent", HTTPConnection.AGENT))
+        if body is not None and "content-length" not in names:
+            headers.append(("Content-Length", format(len(body))))
+        reusable = "close" not in (value.lower()
+            for [name, value] in headers if name.lower() == "connection")
+        
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = asyncio.Semaphore(self.max_per_host)
+            self._limits[key] = limit
+        await limit.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key)
+                reused = bool(idle)
+                if reused:
+                    connection = idle.pop()
+                else:
+                    connection = await self._connect(key)
+                try:
+                    connection.putrequest(method, target)
+                    for header in headers:
+                        connection.putheader(*header)
+                    await connection.endheaders(body)
+                    response = await connection.getresponse()
+                except (ConnectionError, BadStatusLine):
+                    connection.sock.close()
+                    # Retry on a new connection if an idle one had been
+                    # closed by the server
+                    if not reused or method not in net.IDEMPOTENT_METHODS:
+                        raise
+                    continue
+                except:
+                    connection.sock.close()
+                    raise
                 break
-            
-            chunk_read = Future(loop=self.sock.loop)
-            self.next_size.set_result((size, chunk_read))
-            await chunk_read
+        except:
+            limit.release()
+            raise
+        
+        if isinstance(response, _EofResponse) or response.version < 11:
+            reusable = False
+        for option in net.header_list(response.msg, "Connection"):
+            if option.lower() == "close":
+                reusable = False
+        return ClientResponse(self, key, connection, response, reusable)
+    
+    async def _connect(self, key):
+        from .cares import name_connect
+        
+        [scheme, host, port] = key
+        sock = await name_connect(self.loop, (host, port),
+            partial(Socket, loop=self.loop), message=self.message)
+        try:
+            if scheme == "https":
+                context = self.ssl_context
+                if context is None:
+                    context = ssl.create_default_context()
+                sock = Ssl(context, sock, server_hostname=host)
+                await sock.handshake()
+        except:
+            sock.close()
+            raise
+        return HTTPConnection(sock)
+    
+    def _release(self, key, connection, reuse):
+        if reuse:
+            self._idle.setdefault(key, list()).append(connection)
         else:
-            raise ExcessError("30000 or more chunks")
+            connection.sock.close()
+        self._limits[key].release()
+    
+    def close(self):
+        for connections in self._idle.values():
+            while connections:
+                connections.pop().sock.close()
+
+class ClientResponse(Context):
+    """Response returned by AsyncClient
+    
+    Has the "status", "reason", "version" and "msg" attributes of the
+    underlying response. Once the body has been read to the end, any
+    trailer fields of a chunked response are in "trailers"."""
+    
+    def __init__(self, client, key, connection, response, reusable):
+        self.status = response.status
+        self.reason = response.reason
+        self.version = response.version
+        self.msg = response.msg
+        self._client = client
+        self._key = key
+        self._connection = connection
+        self._response = response
+        self._reusable = reusable
+        self.trailers = None
+        if isinstance(response, _LengthResponse) and not response.size:
+            self._release(reusable)
+    
+    async def read(self, amt=None):
+        """Read up to "amt" bytes, or to the end of the body by default"""
+        
+        if amt is None:
+            body = bytearray()
+            while True:
+                data = await self.read(0x10000)
+                if not data:
+                    return bytes(body)
+                body.extend(data)
         
-        self.next_size.set_exception(EOFError())
-        await parser.headers()
+        if self._response is None:
+            return b""
+        try:
+            data = await self._response.read(amt)
+        except:
+            self._release(False)
+            raise
+        self._check_end(amt, data)
+        return data
+    
+    async def readinto(self, b):
+        if self._response is None:
+            return 0
+        try:
+            n = await self._response.readinto(b)
+        except:
+            self._release(False)
+            raise
+        with memoryview(b) as view:
+            self._check_end(view.nbytes, n)
+        return n
+    
+    def _check_end(self, requested, received):
+        """Release the connection once the body has been read to the end
+        
+        The connection is only reused if the body decoder finished."""
+        
+        response = self._response
+        if isinstance(response, _ChunkedResponse):
+            end = response.size is None
+        elif isinstance(response, _LengthResponse):
+            end = not response.size
+        else:  # Delimited by the connection closing
+            end = requested and not received
+        if end:
+            self._release(self._reusable)
+    
+    def close(self):
+        if self._response is not None:
+            self._release(False)
+    
+    def _release(self, reuse):
+        self.trailers = getattr(self._response, "trailers", None)
+        self._response = None
+        self._client._release(self._key, self._connection, reuse)
 
-class Parser:
-    """
-    "c" may hold last read character; empty string at EOF
+class Pipeline(Context):
+    """Sends several requests on a connection without waiting for responses
+    
+    async def connect():
+        ...
+        return HTTPConnection(sock)
+    pipeline = Pipeline(connect)
+    for target in ("/one", "/two", "/three"):
+        await pipeline.request("GET", target, (("Host", "example"),))
+    for _ in range(3):
+        response = await pipeline.getresponse()
+        ...  # Read to the end before getting the next response
+    pipeline.close()
+    
+    Only idempotent requests may be pipelined. If the connection is closed
+    before all responses are received, the unanswered requests are sent
+    again on a new connection from "connect"."""
+    
+    def __init__(self, connect):
+        self._connect = connect
+        self.connection = None
+        self._pending = deque()  # Requests awaiting responses
+        self._answered = 0  # Responses received on current connection
+    
+    async def request(self, method, target, headers=(), body=None):
+        if method not in net.IDEMPOTENT_METHODS:
+            msg = "Cannot pipeline non-idempotent {} request".format(method)
+            raise ValueError(msg)
+        request = (method, target, tuple(headers), body)
+        if self.connection is None:
+            await self._reconnect()
+        self._pending.append(request)
+        await self._send(request)
+    
+    async def getresponse(self):
+        """Return the response to the oldest request without one"""
+        
+        while True:
+            try:
+                response = await self.connection.getresponse()
+            except (ConnectionError, BadStatusLine):
+                # Only replay requests if the server answered some on this
+                # connection, otherwise it may never respond
+                if not self._answered:
+                    raise
+                await self._reconnect()
+                continue
+            break
+        self._pending.popleft()
+        self._answered += 1
+        return response
+    
+    async def _reconnect(self):
+        self.close()
+        self.connection = await self._connect()
+        self._answered = 0
+        for request in self._pending:
+            await self._send(request)
+    
+    async def _send(self, request):
+        [method, target, headers, body] = request
+        self.connection.putrequest(method, target)
+        for header in headers:
+            self.connection.putheader(*header)
+        try:
+            await self.connection.endheaders(body)
+        except ConnectionError:
+            pass  # Continue and read any responses that were sent
+    
+    def close(self):
+        if self.connection is not None:
+            self.connection.sock.close()
+            self.connection = None
+
+class Server(Context):
+    """HTTP/1.1 server running on an event loop
+    
+    async def handler(request):
+        name = await request.read()
+        return (200, [("Content-Type", "text/plain")], b"Hello " + name)
+    
+    with Server(handler, ("", 8080), loop=loop) as server:
+        loop.run_until_complete(server.serve_forever())
+    
+    Each connection is served by its own task, so that an idle persistent
+    connection only costs a socket and a buffer. The handler is called
+    with a ServerRequest, and returns the status code, a sequence of
+    header fields, and a bytes-like body. Unless given, Content-Length is
+    added. Unread parts of request bodies are discarded. The task running
+    serve_forever() should be cancelled before the server is closed.
     """
     
+    default_port = 0
+    
+    def __init__(self, handler, address=("", None), *, loop,
+            ssl_context=None, backlog=100):
+        [host, port] = address
+        if port is None:
+            port = self.default_port
+        self.handler = handler
+        self.loop = loop
+        self.ssl_context = ssl_context
+        self._connections = set()  # Tasks serving connections
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        self.sock = Socket(family, loop=loop)
+        try:
+            self.sock.sock.setsockopt(socket.SOL_SOCKET,
+                socket.SO_REUSEADDR, 1)
+            self.sock.sock.bind((host, port))
+            self.sock.sock.listen(backlog)
+        except:
+            self.sock.close()
+            raise
+        self.server_address = self.sock.sock.getsockname()
+    
+    # Seconds to wait after failing to accept, such as when out of file
+    # descriptors
+    ACCEPT_DELAY = 0.1
+    
+    async def serve_forever(self):
+        """Accept connections until cancelled"""
+        while True:
+            try:
+                [sock, address] = await self.sock.accept()
+            except ConnectionError:
+                continue
+            except OSError:  # Such as EMFILE or ENFILE
+                self.handle_error(None)
+                await asyncio.sleep(self.ACCEPT_DELAY)
+                continue
+            task = self.loop.create_task(self._serve(sock, address))
+            self._connections.add(task)
+            task.add_done_callback(self._connections.discard)
+    
+    async def _serve(self, sock, address):
+        try:
+            if self.ssl_context is not None:
+                sock = Ssl(self.ssl_context, sock, server_side=True)
+                await sock.handshake()
+            parser = Parser(Reader(sock))
+            while await self._exchange(sock, parser, address):
+                pass
+        except EOFError:  # Closed by client between requests
+            pass
+        except:
+            self.handle_error(address)
+        finally:
+            sock.close()
+    
+    async def _exchange(self, sock, parser, address):
+        """Handle a request; returns False to close the connection"""
+        
+        try:
+            [method, target, version] = await parser.request_line()
+            msg = await parser.headers()
+            body = self._body(parser.reader, msg)
+        except (HTTPException, ExcessError, ValueError):
+            await self._respond(sock, "GET", 11,
+                (http.client.BAD_REQUEST, (), b""), True)
+            return False
+        
+        options = {option.lower()
+            for option in net.header_list(msg, "Connection")}
+        if version < 11:
+            close = "keep-alive" not in options
+        else:
+            close = "close" in options
+            for expectation in net.header_list(msg, "Expect"):
+                if expectation.lower() == "100-continue":
+                    await sock.sendall(b"HTTP/1.1 100 Continue\r\n\r\n")
+        
+        request = ServerRequest(method, target, version, msg, body)
+        try:
+            response = await self.handler(request)
+        except Exception:
+            self.handle_error(address)
+            response = (http.client.INTERNAL_SERVER_ERROR, (), b"")
+            close = True
+        
+        # Finish the request before the next one can be read
+        if not close:
+            while await request.read(Reader.BLOCK_SIZE):
+                pass
+        
+        for [name, value] in response[1]:
+            if name.lower() == "connection" and "close" in value.lower():
+                close = True
+        await self._respond(sock, method, version, response, close)
+        return not close
+    
+    def _body(self, reader, msg):
+        encodings = net.header_list(msg, "Transfer-Encoding")
+        encoding = next(encodings, None)
+        if encoding is None:
+            lengths = net.header_list(msg, "Content-Length")
+            return _LengthBody(reader, next(lengths, "0"), lengths)
+        if next(encodings, None) is not None or encoding.lower() != "chunked":
+            raise UnknownTransferEncoding("Not chunked transfer encoding")
+        return _ChunkedBody(reader)
+    
+    async def _respond(self, sock, method, version, response, close):
+        [status, headers, body] = response
+        reason = http.client.responses.get(status, "")
+        buffer = bytearray(b"HTTP/1.1 %d " % status)
+        buffer.extend(reason.encode("ascii"))
+        buffer.extend(CRLF)
+        names = set()
+        for [name, value] in headers:
+            names.add(name.lower())
+            _put_field(buffer, name, value)
+        
+        no_body = status < 200 or status in {
+            http.client.NO_CONTENT, http.client.NOT_MODIFIED}
+        if (not no_body and "content-length" not in names
+                and "transfer-encoding" not in names):
+            _put_field(buffer, "Content-Length", format(len(body)))
+        if "connection" not in names:
+            if close:
+                _put_field(buffer, "Connection", "close")
+            elif version < 11:
+                _put_field(buffer, "Connection", "keep-alive")
+        buffer.extend(CRLF)
+        
+        if method == "HEAD" or no_body:
+            await sock.sendall(buffer)
+        elif len(body) <= HTTPConnection.BODY_COALESCE_LIMIT:
+            buffer.extend(body)
+            await sock.sendall(buffer)
+        else:
+            await sock.sendall_many((buffer, body))
+    
+    def handle_error(self, client_address):
+        """Called with an exception being handled for a connection
+        
+        Like "net.Server.handle_error()", ignores errors caused by clients
+        disconnecting, and passes on exceptions that are not errors."""
+        
+        [_, exc, *_] = sys.exc_info()
+        if net.ignored_server_error(exc):
+            return
+        if not isinstance(exc, Exception):
+            raise
+        print("-" * 40, file=sys.stderr)
+        print("Exception occurred during processing of request from",
+            client_address, file=sys.stderr)
+        traceback.print_exc()
+        print("-" * 40, file=sys.stderr)
+    
+    def close(self):
+        self.sock.close()
+        for task in self._connections:
+            task.cancel()
+
+def _put_field(buffer, name, value):
+    buffer.extend(name.encode("ascii"))
+    buffer.extend(b": ")
+    buffer.extend(value.encode("latin-1"))
+    buffer.extend(CRLF)
+
+class ServerRequest:
+    """Request received by Server
+    
+    Has "method", "target" and "version" attributes from the request line,
+    with the version being 10 or 11 like "HTTPResponse.version", and the
+    header fields in "msg". After a chunked body has been read to the
+    end, any trailer fields are in "trailers"."""
+    
+    def __init__(self, method, target, version, msg, body):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.msg = msg
+        self._body = body
+    
+    async def read(self, amt=None):
+        """Read up to "amt" bytes, or to the end of the body by default"""
+        if amt is None:
+            body = bytearray()
+            while True:
+                data = await self._body.read(Reader.BLOCK_SIZE)
+                if not data:
+                    return bytes(body)
+                body.extend(data)
+        return await self._body.read(amt)
+    
+    def readinto(self, b):
+        return self._body.readinto(b)
+    
+    @property
+    def trailers(self):
+        return getattr(self._body, "trailers", None)
+
+class Reader:
+    """Buffers data received from a socket
+    
+    Data is received in large blocks, so that line endings can be found
+    without a system call and event loop iteration for each character.
+    Data left over after a line is kept for the next read."""
+    
+    BLOCK_SIZE = 0x10000
+    
     def __init__(self, sock):
         self.sock = sock
+        self.buffer = bytearray()
+    
+    async def fill(self):
+        """Receive another block into the buffer
+        
+        Returns False at EOF"""
+        data = await self.sock.recv(self.BLOCK_SIZE)
+        self.buffer.extend(data)
+        return bool(data)
+    
+    async def readline(self, limit):
+        """Read a line including its LF terminator
+        
+        At EOF, the line is returned without a terminator, or is empty.
+        Raises ExcessError if the line would be "limit" or more bytes."""
+        
+        start = 0
+        while True:
+            end = self.buffer.find(b"\n", start)
+            if end >= 0:
+                end += 1
+                break
+            start = len(self.buffer)
+            end = start
+            if start >= limit or not await self.fill():
+                break
+        if end >= limit:
+            raise ExcessError("Line of {} or more characters".format(limit),
+                bytes(self.buffer[:limit]))
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+    
+    async def peek(self):
+        """Return the next byte without consuming it; empty at EOF"""
+        if not self.buffer:
+            await self.fill()
+        return bytes(self.buffer[:1])
+    
+    async def read(self, amt):
+        """Return buffered data, or receive up to "amt" bytes"""
+        if not self.buffer:
+            return await self.sock.recv(amt)
+        data = bytes(self.buffer[:amt])
+        del self.buffer[:amt]
+        return data
+    
+    async def readinto(self, b):
+        """Copy buffered data into "b", or receive directly into it"""
+        if not self.buffer:
+            return await self.sock.recv_into(b)
+        with memoryview(self.buffer) as buffer:
+            with memoryview(b) as view, view.cast("B") as bytes:
+                n = min(len(bytes), len(buffer))
+                bytes[:n] = buffer[:n]
+        del self.buffer[:n]
+        return n
+
+class Parser:
+    def __init__(self, reader):
+        self.reader = reader
     
     SPACE_LIMIT = 8
     TOKEN_LIMIT = 120
     NUMBER_LIMIT = 9
+    LINE_LIMIT = 3000
+    REASON_LIMIT = 400
+    HEADER_LIMIT = 30000  # Lines in a header or trailer section
     
-    async def headers(self):
-        """
-        Entry with self.c = first character of headers
-        Leaves with self.c not set
-        """
+    STATUS_LINE = r"""
+        [^\S\r\n]{0,%(space)d} HTTP/ ([0-9]{1,%(number)d}) \.
+        ([0-9]{0,%(number)d}) \S{0,%(token)d} [^\S\r\n]{0,%(space)d}
+        ([0-9]{3}) [^\S\r\n]{0,%(space)d} (.*)
+    """ % dict(space=SPACE_LIMIT - 1, token=TOKEN_LIMIT - 1,
+        number=NUMBER_LIMIT - 1)
+    STATUS_LINE = re.compile(STATUS_LINE.encode("ascii"),
+        re.VERBOSE | re.DOTALL)
+    
+    REQUEST_LINE = r"""
+        ([!#$%%&'*+.^_`|~0-9A-Za-z-]{1,%(token)d}) [ ]{1,%(space)d}
+        (\S+) [ ]{1,%(space)d}
+        HTTP/ ([0-9]{1,%(number)d}) \. ([0-9]{1,%(number)d})
+        [^\S\r\n]{0,%(space)d} \r?\n?
+    """ % dict(space=SPACE_LIMIT, token=TOKEN_LIMIT - 1,
+        number=NUMBER_LIMIT - 1)
+    REQUEST_LINE = re.compile(REQUEST_LINE.encode("ascii"), re.VERBOSE)
+    
+    async def request_line(self):
+        """Returns (method, target, version) tuple
         
-        parser = email.parser.FeedParser()
+        Empty lines before the request line are skipped. Raises EOFError
+        if the connection is closed first."""
         
-        blank_line = True
-        for _ in range(30000):
-            if not self.c:
+        for _ in range(self.SPACE_LIMIT):
+            line = await self.reader.readline(self.LINE_LIMIT)
+            if not line:
+                raise EOFError()
+            if line not in {b"\r\n", b"\n"}:
                 break
-            parser.feed(self.c.decode("latin-1"))
-            if self.c == b"\n":
-                if blank_line:
-                    break
-                blank_line = True
-            elif self.c != b"\r":
-                blank_line = False
-            await self.next_char()
-        else:
-            raise ExcessError("30000 or more headers")
-        return parser.close()
-    
-    async def space(self):
-        """Read and skip over spaces
-        
-        Entry with c = any char
-        """
-        
-        space = bytearray()
-        for i in range(self.SPACE_LIMIT):
-            if i:
-                await self.next_char()
-            if not self.at_lws():
-                return bytes(space)
-            space.extend(self.c)
         else:
-            raise ExcessError("Excessive space", bytes(space))
+            raise ExcessError("{} or more empty lines".format(
+                self.SPACE_LIMIT))
+        match = self.REQUEST_LINE.fullmatch(line)
+        if not match:
+            raise BadRequestLine(line)
+        [method, target, major, minor] = match.groups()
+        if int(major) != 1:
+            raise UnknownProtocol("HTTP/{}".format(major.decode("ascii")))
+        version = 11 if int(minor) else 10
+        return (method.decode("ascii"), target.decode("latin-1"), version)
+    
+    async def status_line(self):
+        """Returns (version, status, reason) tuple
+        
+        The version is 10 for HTTP/1.0 and 11 for HTTP/1.1 or later,
+        like "http.client"."""
+        
+        line = await self.reader.readline(self.LINE_LIMIT)
+        match = self.STATUS_LINE.match(line)
+        if not match:
+            raise BadStatusLine(line)
+        [major, minor, status, reason] = match.groups()
+        if int(major) != 1:
+            raise UnknownProtocol("HTTP/{}".format(major.decode("ascii")))
+        version = 11 if int(minor or b"0") else 10
+        
+        # Reason phrase may continue on following lines
+        reason = bytearray(reason)
+        while True:
+            if len(reason) >= self.REASON_LIMIT:
+                raise ExcessError("Status reason of {} or more characters"
+                    .format(self.REASON_LIMIT))
+            if not await self.at_lws():
+                break
+            reason.extend(await self.reader.readline(self.LINE_LIMIT))
+        return (version, status, reason.rstrip())
     
-    def at_lws(self):
-        return self.c.isspace() and self.c not in CRLF
+    async def headers(self):
+        """Parse header lines up to and including the blank line
+        
+        Returns an "http.client.HTTPMessage". Folded lines are joined with
+        a space, and lines without a colon are recorded in its "defects"
+        list and otherwise ignored."""
+        
+        msg = http.client.HTTPMessage()
+        field = None  # Latest field, which may continue on following lines
+        for _ in range(self.HEADER_LIMIT):
+            line = await self.reader.readline(self.LINE_LIMIT)
+            if line[:1] in {b" ", b"\t"} and field is not None:
+                field[1].extend(b" ")
+                field[1].extend(line.strip())
+                continue
+            if field is not None:
+                [name, value] = field
+                msg[name.decode("latin-1")] = value.decode("latin-1")
+                field = None
+            if line in {b"\r\n", b"\n", b""}:
+                return msg
+            [name, colon, value] = line.partition(b":")
+            if not colon:
+                msg.defects.append(
+                    MissingHeaderBodySeparatorDefect(repr(line)))
+                continue
+            field = (name.rstrip(), bytearray(value.strip()))
+        raise ExcessError("{} or more header lines".format(
+            self.HEADER_LIMIT))
     
-    async def next_char(self):
-        self.c = await self.sock.recv(1)
+    async def at_lws(self):
+        c = await self.reader.peek()
+        return c.isspace() and c not in CRLF
 
 class ExcessError(EnvironmentError):
     def __init__(self, msg, data=None):
@@ -308,4 +966,12 @@ class BadStatusLine(http.client.BadStatusLine):
     def __init__(self, line):
         Exception.__init__(self, repr(line))
 
+class BadRequestLine(HTTPException):
+    def __init__(self, line):
+        Exception.__init__(self, repr(line))
+
 CRLF = b"\r\n"
+UNSAFE_TARGET = re.compile(br"[\x00- ]")
+CHUNK_SIZE = re.compile(br"[^\S\r\n]*([0-9A-Fa-f]*)")
+CONTENT_LENGTH = re.compile(r"[0-9]+")
+TRAILER_END = re.compile(br"\n\r?\n")
@@ -1,8 +1,11 @@
 import socket
 import ssl
+import os
 from ssl import SSLWantReadError, SSLWantWriteError
 from misc import Context
 from asyncio import Future
+from collections import deque
+from itertools import islice
 
 class Socket(Context):
     """Provides coroutines for common blocking socket operations"""
@@ -13,45 +16,107 @@ class Socket(Context):
         self.sock.setblocking(False)
     
     async def connect(self, *args, **kw):
+        try:
+            self.sock.connect(*args, **kw)
+        except BlockingIOError:
+            await self._wait(self.loop.add_writer, self.loop.remove_writer)
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise OSError(err, os.strerror(err))
+    
+    async def accept(self):
+        """Accept a connection on a listening socket
+        
+        Returns (Socket, address) for the new connection."""
+        
         while True:
             try:
-                self.sock.connect(*args, **kw)
+                [sock, address] = self.sock.accept()
                 break
             except BlockingIOError:
-                pass
-            future = Future(loop=self.loop)
-            self.loop.add_writer(self.sock.fileno(), future.set_result, None)
-            await future
+                await self._wait(self.loop.add_reader,
+                    self.loop.remove_reader)
+        return (Socket(fileno=sock.detach(), loop=self.loop), address)
     
     async def recv(self, *args, **kw):
+        return await self._receive(self.sock.recv, *args, **kw)
+    
+    async def recv_into(self, *args, **kw):
+        """Receive directly into a writable buffer, such as a bytearray"""
+        return await self._receive(self.sock.recv_into, *args, **kw)
+    
+    async def _receive(self, recv, *args, **kw):
         while True:
             try:
-                return self.sock.recv(*args, **kw)
+                return recv(*args, **kw)
             except (BlockingIOError, SSLWantReadError):
                 pass
-            future = Future(loop=self.loop)
-            self.loop.add_reader(self.sock.fileno(), future.set_result, None)
-            await future
+            await self._wait(self.loop.add_reader, self.loop.remove_reader)
     
     async def sendall(self, data, *args, **kw):
-        while data:
+        with memoryview(data) as view, view.cast("B") as bytes:
+            sent = 0
+            while sent < len(bytes):
+                try:
+                    sent += self.sock.send(bytes[sent:], *args, **kw)
+                except (BlockingIOError, SSLWantWriteError):
+                    await self._wait(self.loop.add_writer,
+                        self.loop.remove_writer)
+                except SSLWantReadError:
+                    await self._wait(self.loop.add_reader,
+                        self.loop.remove_reader)
+    
+    # Limit on buffers passed to each sendmsg() call
+    IOV_MAX = 1024
+    
+    async def sendall_many(self, buffers):
+        """Send a sequence of buffers with scatter-gather writes"""
+        
+        views = deque()
+        for buffer in buffers:
+            view = memoryview(buffer).cast("B")
+            if view:
+                views.append(view)
+        while views:
             try:
-                data = data[self.sock.send(data, *args, **kw):]
-                break
-            except SSLWantReadError:
-                future = Future(loop=self.loop)
-                self.loop.add_reader(self.sock.fileno(), future.set_result,
-                    None)
-                await future
+                sent = self.sock.sendmsg(islice(views, self.IOV_MAX))
+            except BlockingIOError:
+                await self._wait(self.loop.add_writer,
+                    self.loop.remove_writer)
+                continue
+            while sent:  # Drop sent data from the start of the queue
+                if sent < len(views[0]):
+                    views[0] = views[0][sent:]
+                    break
+                sent -= len(views.popleft())
+    
+    async def _wait(self, add_watcher, remove_watcher):
+        """Wait until the socket is ready
+        
+        The watcher is removed afterwards, because some event loops keep
+        calling it back until it is removed."""
+        
+        fd = self.sock.fileno()
+        future = Future(loop=self.loop)
+        add_watcher(fd, future.set_result, None)
+        try:
+            await future
+        finally:
+            remove_watcher(fd)
     
     def close(self, *args, **kw):
         self.sock.close(*args, **kw)
 
 class Ssl(Socket):
-    def __init__(self, context, socket):
+    def __init__(self, context, socket, **kw):
         self.loop = socket.loop
         self.sock = context.wrap_socket(socket.sock,
-            do_handshake_on_connect=False)
+            do_handshake_on_connect=False, **kw)
+    
+    async def sendall_many(self, buffers):
+        # SSL sockets do not implement sendmsg()
+        for buffer in buffers:
+            await self.sendall(buffer)
     
     async def handshake(self, *args, **kw):
         while True:
@@ -59,9 +124,8 @@ class Ssl(Socket):
                 self.sock.do_handshake(*args, **kw)
                 break
             except SSLWantReadError:
-                add_watcher = self.loop.add_reader
+                await self._wait(self.loop.add_reader,
+                    self.loop.remove_reader)
             except SSLWantWriteError:
-                add_watcher = self.loop.add_writer
-            future = Future(loop=self.loop)
-            add_watcher(self.sock.fileno(), future.set_result, None)
-            await future
+                await self._wait(self.loop.add_writer,
+                    self.loop.remove_writer)
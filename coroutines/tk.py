@@ -62,11 +62,18 @@ class EventLoop(_EventLoop):
     def remove_writer(self, *pos, **kw):
         return self._remove_filehandler(tkinter.WRITABLE, *pos, **kw)
     def _remove_filehandler(self, mask, fd):
-        callbacks = self._filehandlers[fd]
+        # Handlers are already removed once they have been called
+        callbacks = self._filehandlers.get(fd, ())
+        if mask not in callbacks:
+            return False
         del callbacks[mask]
-        if not callbacks:
-            self._widget.tk.deletefilehandler(fd)
+        self._widget.tk.deletefilehandler(fd)
+        if callbacks:
+            mask = reduce(operator.or_, callbacks.keys())
+            self._widget.tk.createfilehandler(fd, mask, self._filehandler)
+        else:
             del self._filehandlers[fd]
+        return True
     
     def _filehandler(self, fd, mask):
         self._widget.tk.deletefilehandler(fd)
@@ -1,4 +1,3 @@
-from urllib.parse import urlsplit, urlunsplit
 import urllib.parse
 from socketserver import BaseServer
 import sys
@@ -8,16 +7,30 @@ import urllib.request
 import http.client
 from errno import EPIPE, ENOTCONN, ECONNRESET
 from select import select
-from contextlib import contextmanager
-from streams import DelegateWriter, TeeReader
+from contextlib import contextmanager, ExitStack
+from streams import Reader, DelegateWriter, TeeReader, streamcopy, pump
 import os, os.path
 import hashlib
+import re
+import ipaddress
+from socket import inet_pton, AF_INET6
 from base64 import urlsafe_b64encode
-from email.message import Message
-import email.generator
-from io import TextIOWrapper
+import email.utils
+from io import TextIOWrapper, BufferedIOBase, BytesIO, FileIO
 from gzip import GzipFile
 import mimetypes
+from collections import OrderedDict, namedtuple, Counter
+import time
+from functools import partial
+from itertools import islice
+import threading
+import atexit
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import sqlite3
+import urllib.error
+import tempfile
+import lzma
+import zlib
 
 try:  # Python 3.3
     ConnectionError
@@ -26,25 +39,153 @@ except NameError:  # Python < 3.3
 
 DISCONNECTION_ERRNOS = {EPIPE, ENOTCONN, ECONNRESET}
 
+# Requests that may be retried if the connection fails
+IDEMPOTENT_METHODS = frozenset(
+    {"GET", "HEAD", "PUT", "DELETE", "TRACE", "OPTIONS"})
+
 def url_port(url, scheme, ports):
     """Raises "ValueError" if the URL is not valid"""
+    url = ParsedUrl(url, scheme, ports)
+    return dict(scheme=url.scheme, hostname=url.hostname, port=url.port,
+        path=url.path, username=url.username, password=url.password)
+
+def parse_urls(urls, scheme="http", ports={"http": 80, "https": 443}):
+    """Generate a ParsedUrl for each URL
     
-    parsed = urlsplit(url, scheme=scheme)
-    if not parsed.hostname:
-        parsed = urlsplit("//" + url, scheme=scheme)
-    if not parsed.hostname:
-        raise ValueError("No host name specified: {0!r}".format(url))
+    Raises "ValueError" for the first URL that is not valid."""
+    for url in urls:
+        yield ParsedUrl(url, scheme, ports)
+
+class ParsedUrl:
+    """Components of a URL, as accepted by url_port()
     
-    try:
-        def_port = ports[parsed.scheme]
-    except LookupError:
-        raise ValueError("Unhandled scheme: {0}".format(parsed.scheme))
-    port = parsed.port
-    if port is None:
-        port = def_port
-    path = urlunsplit(("", "", parsed.path, parsed.query, parsed.fragment))
-    return dict(scheme=parsed.scheme, hostname=parsed.hostname, port=port,
-        path=path, username=parsed.username, password=parsed.password)
+    If the URL has no scheme, "scheme" is used. If the URL has no host
+    name, it is parsed again assuming it starts with one, so that
+    "example.com:8080/path" is accepted. The "port" attribute is the
+    explicit port, or else the default port from "ports" for the scheme.
+    The "path" attribute includes any query and fragment. Parsing is
+    equivalent to urlsplit(), but without building intermediate
+    objects."""
+    
+    __slots__ = (
+        "scheme", "username", "password", "hostname", "port", "path",
+        "default_port",
+    )
+    
+    def __init__(self, url, scheme, ports):
+        original = url
+        if not _URL_UNSAFE.isdisjoint(url):
+            url = url.translate(_URL_UNSAFE_REMOVE)
+        [parsed_scheme, netloc, rest] = _URL_PATTERN.match(
+            url.lstrip(_URL_STRIPPED)).groups()
+        [host, port] = _split_hostinfo(netloc)
+        if not host:
+            [parsed_scheme, netloc, rest] = _URL_PATTERN.match(
+                "//" + url).groups()
+            [host, port] = _split_hostinfo(netloc)
+            if not host:
+                msg = "No host name specified: {0!r}".format(original)
+                raise ValueError(msg)
+        
+        self.scheme = (parsed_scheme or scheme).lower()
+        try:
+            self.default_port = ports[self.scheme]
+        except LookupError:
+            raise ValueError("Unhandled scheme: {0}".format(self.scheme))
+        
+        [userinfo, at, _] = netloc.rpartition("@")
+        if at:
+            [self.username, colon, self.password] = userinfo.partition(":")
+            if not colon:
+                self.password = None
+        else:
+            self.username = self.password = None
+        self.hostname = _lower_host(host)
+        if port:
+            self.port = _parse_port(port)
+        else:
+            self.port = self.default_port
+        
+        # Drop empty query and fragment delimiters, like urlunsplit()
+        [rest, hash, fragment] = rest.partition("#")
+        [path, question, query] = rest.partition("?")
+        if query:
+            path += "?" + query
+        if fragment:
+            path += "#" + fragment
+        self.path = path
+    
+    def normalized(self):
+        """Return the URL with the scheme and host in lower case, and
+        without any default port, suitable for comparing URLs"""
+        
+        port = self.port
+        if port == self.default_port:
+            port = None
+        netloc = format_addr((self.hostname, port))
+        if self.username is not None:
+            userinfo = self.username
+            if self.password is not None:
+                userinfo += ":" + self.password
+            netloc = userinfo + "@" + netloc
+        return "{}://{}{}".format(self.scheme, netloc, self.path)
+    
+    def __repr__(self):
+        return "<{} {!r}>".format(type(self).__name__, self.normalized())
+
+def _split_hostinfo(netloc):
+    """Return (host, port) from a URL authority, like urlsplit()"""
+    if netloc is None:
+        return (None, None)
+    if "[" in netloc or "]" in netloc:
+        _check_brackets(netloc)
+    hostinfo = netloc.rpartition("@")[2]
+    [_, bracket, bracketed] = hostinfo.partition("[")
+    if bracket:
+        [host, _, port] = bracketed.partition("]")
+        port = port.partition(":")[2]
+    else:
+        [host, _, port] = hostinfo.partition(":")
+    return (host, port)
+
+def _check_brackets(netloc):
+    """Raise ValueError unless brackets enclose a valid IPv6 address"""
+    if "[" not in netloc or "]" not in netloc:
+        raise ValueError("Invalid IPv6 URL")
+    host = netloc.partition("[")[2].partition("]")[0]
+    if host.startswith("v"):
+        if not _IPV_FUTURE.match(host):
+            raise ValueError("IPvFuture address is invalid")
+        return
+    try:  # Much faster than the "ipaddress" module for plain addresses
+        inet_pton(AF_INET6, host)
+        return
+    except (OSError, ValueError):
+        pass
+    if not isinstance(ipaddress.ip_address(host), ipaddress.IPv6Address):
+        raise ValueError("An IPv4 address cannot be in brackets")
+
+def _lower_host(host):
+    """Convert a host name to lower case, except for any IPv6 zone"""
+    [host, percent, zone] = host.partition("%")
+    return host.lower() + percent + zone
+
+def _parse_port(port):
+    if not port.isdigit() or not port.isascii():
+        msg = "Port could not be cast to integer value as {!r}"
+        raise ValueError(msg.format(port))
+    port = int(port)
+    if port > 0xFFFF:
+        raise ValueError("Port out of range 0-65535")
+    return port
+
+_IPV_FUTURE = re.compile(r"v[a-fA-F0-9]+\..+\Z", re.DOTALL)
+
+_URL_PATTERN = re.compile(
+    r"(?:([A-Za-z][A-Za-z0-9+.-]*):)?(?://([^/?#]*))?(.*)", re.DOTALL)
+_URL_STRIPPED = "".join(map(chr, range(0x21)))  # C0 controls and space
+_URL_UNSAFE = frozenset("\t\r\n")
+_URL_UNSAFE_REMOVE = dict.fromkeys(map(ord, _URL_UNSAFE))
 
 def Url(scheme="", netloc="", path="", params="", query="", fragment=""):
     return urllib.parse.ParseResult(
@@ -62,25 +203,105 @@ scheme=None, netloc=None, path=None, params=None, query=None, fragment=None):
 
 def format_addr(address):
     [address, port] = address
-    if not frozenset("[]:").isdisjoint(address):
-        address = "[{}]".format(address)
+    if ":" in address or "[" in address or "]" in address:
+        address = "[" + address + "]"
     if port is not None:
         address = "{}:{}".format(address, port)
     return address
 
+def format_addrs(addresses):
+    """Format a list of addresses from (host, port) pairs"""
+    return list(map(format_addr, addresses))
+
 def parse_addr(address, defport=None):
-    address = Url(netloc=address)
-    host = address.hostname
-    if host is None:
-        host = ""
-    port = address.port
-    if port is None:
+    """Split "host:port" into a (host, port) tuple
+    
+    Host names are converted to lower case. Raises ValueError for an
+    invalid port or bracketed IPv6 address."""
+    
+    [host, port] = _split_hostinfo(address)
+    if port:
+        port = _parse_port(port)
+    else:
         port = defport
-    return (host, port)
+    return (_lower_host(host), port)
+
+def parse_addrs(addresses, defport=None):
+    """Parse a list of (host, port) tuples from address strings"""
+    return [parse_addr(address, defport) for address in addresses]
 
 def header_list(message, header):
     for header in message.get_all(header, ()):
-        yield from header_split(header, ",")
+        cache = header_cache
+        if cache is None:
+            yield from header_split(header, ",")
+        else:
+            yield from cache.get(",", header, _split_list)
+
+def _split_list(header):
+    return tuple(header_split(header, ","))
+
+def header_params_list(message, header):
+    """Yield (value, FrozenHeaderParams) for each element of a list header
+    
+    Suitable for fields like "Accept: text/html; q=0.9, */*; q=0.1"."""
+    
+    for elem in header_list(message, header):
+        [value, params] = header_partition(elem, ";")
+        yield (value, header_params(params))
+
+def header_params(params):
+    """Parse parameters into FrozenHeaderParams
+    
+    The result may be shared through "header_cache"."""
+    
+    cache = header_cache
+    if cache is None:
+        return FrozenHeaderParams(params)
+    return cache.get(";", params, FrozenHeaderParams)
+
+class HeaderCache:
+    """Bounded LRU cache of parsed header values
+    
+    Values longer than "max_length" are parsed without being cached. The
+    "stats" counter records "hits", "misses" and "evictions"."""
+    
+    def __init__(self, max_entries=1000, max_length=1000):
+        self.max_entries = max_entries
+        self.max_length = max_length
+        self.stats = Counter()
+        self._entries = OrderedDict()  # {(kind, value): parsed result}
+        self._lock = threading.Lock()
+    
+    def get(self, kind, value, parse):
+        """Return parse(value), cached under "kind" and the value
+        
+        The result should be immutable, since it is shared."""
+        
+        if len(value) > self.max_length:
+            return parse(value)
+        key = (kind, value)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return result
+            self.stats["misses"] += 1
+        result = parse(value)
+        with self._lock:
+            self._entries[key] = result
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+        return result
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+# Set to a HeaderCache to memoize header_list() and header_params()
+header_cache = None
 
 class HeaderParams(dict):
     def __init__(self, params):
@@ -102,31 +323,49 @@ class HeaderParams(dict):
         [value] = value
         return value
 
+class FrozenHeaderParams(HeaderParams):
+    """Read-only HeaderParams, with a tuple of values for each name"""
+    
+    def __init__(self, params):
+        values = HeaderParams(params)
+        dict.__init__(self, ((name, tuple(value))
+            for [name, value] in values.items()))
+    
+    def _readonly(self, *pos, **kw):
+        raise TypeError("FrozenHeaderParams is read-only")
+    
+    __setitem__ = __delitem__ = _readonly
+    setdefault = update = pop = popitem = clear = __ior__ = _readonly
+
 def header_split(header, delim):
-    while header:
-        [elem, header] = header_partition(header, delim)
+    pattern = _header_element(delim)
+    pos = 0
+    while pos <= len(header):
+        end = pattern.match(header, pos).end()
+        elem = header[pos:end].strip()
         if elem:
             yield elem
+        pos = end + 1
 
 def header_partition(header, sep):
-    sentinelled = header + sep + '"\\'
-    pos = 0
-    while True:  # For each quoted segment
-        end = sentinelled.index(sep, pos)
-        quote = sentinelled.index('"', pos)
-        if end < quote:
-            break
-        pos = quote + 1
-        while True:  # For each backslash escape in quote
-            quote = sentinelled.index('"', pos)
-            backslash = sentinelled.index("\\", pos)
-            if quote < backslash:
-                break
-            pos = min(backslash + 2, len(header))
-        pos = min(quote + 1, len(header))
-    
+    end = _header_element(sep).match(header).end()
     return (header[:end].strip(), header[end + 1:].strip())
 
+def _header_element(delim):
+    """Return a pattern matching up to a delimiter outside quotes
+    
+    A quote runs until an unescaped quote or the end of the string."""
+    
+    pattern = _header_elements.get(delim)
+    if pattern is None:
+        pattern = r'(?: [^"{0}]+ | " (?: [^"\\]+ | \\.? )* "? )*'
+        pattern = re.compile(pattern.format(re.escape(delim)),
+            re.VERBOSE | re.DOTALL)
+        _header_elements[delim] = pattern
+    return pattern
+
+_header_elements = dict()  # {delimiter: compiled pattern}
+
 def header_unquote(header):
     segments = list()
     while header:  # For each quoted segment
@@ -148,6 +387,36 @@ def header_unquote(header):
         header = header[quote + 1:]
     return "".join(segments)
 
+def send_file(sock, file, length=None):
+    """Send from a binary file object to a socket
+    
+    Sends "length" bytes, or to the end of the file by default, and returns
+    the number of bytes sent. A regular file is sent by the kernel with
+    os.sendfile() if available, without copying through Python buffers.
+    Other files are read and sent in blocks."""
+    
+    # Decompressing readers such as GzipFile also have fileno(), returning
+    # the descriptor of the compressed file
+    if isinstance(getattr(file, "raw", file), FileIO):
+        return sock.sendfile(file, file.tell(), length)
+    
+    output = DelegateWriter(sock.sendall)
+    if length is not None:
+        streamcopy(file, output, length)
+        return length
+    return pump(file, output).copied
+
+def ignored_server_error(exc):
+    """Check for errors caused by a client that servers need not report
+    
+    These are the client disconnecting, and the client rejecting the
+    server's certificate."""
+    
+    if isinstance(exc, ConnectionError):
+        return True
+    return (isinstance(exc, SSLError) and
+        exc.reason == "TLSV1_ALERT_UNKNOWN_CA")
+
 class Server(BaseServer, Context):
     default_port = 0
     
@@ -162,16 +431,75 @@ class Server(BaseServer, Context):
     
     def handle_error(self, request, client_address):
         [_, exc, *_] = sys.exc_info()
-        if isinstance(exc, ConnectionError):
-            return
-        if (isinstance(exc, SSLError) and
-        exc.reason == "TLSV1_ALERT_UNKNOWN_CA"):
+        if ignored_server_error(exc):
             return
         if not isinstance(exc, Exception):
             self.close_request(request)
             raise  # Force server loop to exit
         super().handle_error(request, client_address)
 
+class PooledServer(Server):
+    """Server handling requests in a bounded pool of threads
+    
+    Combine with a class that handles sockets, like socketserver.TCPServer:
+    
+    class HttpServer(net.PooledServer, http.server.HTTPServer):
+        pass
+    
+    Up to "max_workers" requests are handled at once, and up to
+    "max_queue" more wait for a worker. Beyond that, no more requests are
+    accepted until a worker is free. Closing the server stops it accepting
+    requests, and waits up to "drain_timeout" seconds (forever by default)
+    for requests already accepted to finish. Requests still waiting for a
+    worker after that are dropped."""
+    
+    def __init__(self, address=("", None), RequestHandlerClass=None, *,
+            max_workers=8, max_queue=0, drain_timeout=None):
+        self.drain_timeout = drain_timeout
+        self._executor = ThreadPoolExecutor(max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._requests = 0  # Accepted and not yet shut down
+        self._drained = threading.Condition()
+        super().__init__(address, RequestHandlerClass)
+    
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        with self._drained:
+            self._requests += 1
+        try:
+            future = self._executor.submit(self._process,
+                request, client_address)
+        except:
+            self._done(request, None)
+            raise
+        future.add_done_callback(partial(self._done, request))
+    
+    def _process(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+    
+    def _done(self, request, future):
+        """Called once a request is finished, or dropped"""
+        try:
+            self.shutdown_request(request)
+        finally:
+            self._slots.release()
+            with self._drained:
+                self._requests -= 1
+                if not self._requests:
+                    self._drained.notify_all()
+    
+    def close(self):
+        try:
+            Server.close(self)
+            with self._drained:
+                self._drained.wait_for(lambda: not self._requests,
+                    self.drain_timeout)
+        finally:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
 class PersistentConnectionHandler(urllib.request.BaseHandler):
     """URL handler for HTTP persistent connections
     
@@ -279,9 +607,7 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
                     raise
                 raise http.client.BadStatusLine(err) from err
         except (ConnectionError, http.client.BadStatusLine):
-            idempotents = {
-                "GET", "HEAD", "PUT", "DELETE", "TRACE", "OPTIONS"}
-            if req.get_method() not in idempotents:
+            if req.get_method() not in IDEMPOTENT_METHODS:
                 raise
             self._connection.close()
             return None  # Retry requests whose method indicates idempotence
@@ -312,6 +638,218 @@ class PersistentConnectionHandler(urllib.request.BaseHandler):
     def __exit__(self, *exc):
         self.close()
 
+class PooledConnectionHandler(PersistentConnectionHandler):
+    """URL handler keeping persistent connections to multiple hosts
+    
+    with PooledConnectionHandler(timeout=10, max_idle=4) as handler:
+        opener = urllib.request.build_opener(handler)
+        
+        with opener.open("http://localhost/one") as response:
+            response.read()
+        with opener.open("http://example/two") as response:
+            response.read()
+        
+        # Reuses the connection from the first request
+        with opener.open("http://localhost/three") as response:
+            response.read()
+    
+    Connections are pooled by scheme, host name and port. A connection
+    is returned to the pool once its response has been closed or read to
+    the end. Idle connections are closed when "idle_timeout" seconds pass
+    without them being used, and the least recently used ones are closed
+    when there are more than "max_idle". Raises CannotSendRequest if a
+    request would open more than "max_per_host" connections to one host.
+    """
+    
+    def __init__(self, *pos,
+            max_per_host=4, max_idle=10, idle_timeout=None, **kw):
+        PersistentConnectionHandler.__init__(self, *pos, **kw)
+        self.max_per_host = max_per_host
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self._key = None
+        self._idle = OrderedDict()  # {connection: (key, last used)}
+        self._busy = dict()  # {connection: (key, response)}
+    
+    def default_open(self, req):
+        response = PersistentConnectionHandler.default_open(self, req)
+        if response is not None:
+            self._track(response)
+        return response
+    
+    def get_response(self):
+        response = PersistentConnectionHandler.get_response(self)
+        self._track(response)
+        return response
+    
+    @contextmanager
+    def _setup_request(self, req):
+        conn_class = self.conn_classes[req.type]
+        key = (req.type,) + parse_addr(req.host, conn_class.default_port)
+        self._connection = self._checkout(key,
+            partial(conn_class, req.host, *self._pos, **self._kw))
+        self._key = key
+        
+        try:
+            yield
+        except:
+            # Allow caller to make more requests
+            self._discard(self._connection)
+            raise
+    
+    def _checkout(self, key, new_connection):
+        """Return an idle connection for "key", or a new connection"""
+        
+        self._reap()
+        for [connection, [idle_key, _]] in reversed(self._idle.items()):
+            if idle_key == key:
+                del self._idle[connection]
+                break
+        else:
+            count = sum(busy_key == key
+                for [busy_key, _] in self._busy.values())
+            if count >= self.max_per_host:
+                msg = "Too many connections to {}"
+                msg = msg.format(format_addr(key[1:]))
+                raise http.client.CannotSendRequest(msg)
+            connection = new_connection()
+        self._busy[connection] = (key, None)
+        return connection
+    
+    def _track(self, response):
+        """Return the connection to the pool once "response" is closed"""
+        self._busy[self._connection] = (self._key, response)
+    
+    def _discard(self, connection):
+        self._busy.pop(connection, None)
+        connection.close()
+    
+    def _reap(self):
+        """Return connections with completed responses to the idle pool,
+        and close expired and excess idle connections"""
+        
+        now = time.monotonic()
+        for [connection, [key, response]] in tuple(self._busy.items()):
+            if response is not None and response.isclosed():
+                del self._busy[connection]
+                self._idle[connection] = (key, now)
+        
+        if self.idle_timeout is not None:
+            for [connection, [_, used]] in tuple(self._idle.items()):
+                if now - used < self.idle_timeout:
+                    break  # Remaining connections used more recently
+                del self._idle[connection]
+                connection.close()
+        
+        while len(self._idle) > self.max_idle:
+            [connection, _] = self._idle.popitem(last=False)
+            connection.close()
+    
+    def close(self):
+        while self._idle:
+            [connection, _] = self._idle.popitem()
+            connection.close()
+        while self._busy:
+            [connection, _] = self._busy.popitem()
+            connection.close()
+        self._connection = None
+
+class ThreadedConnectionHandler(PooledConnectionHandler):
+    """Connection pool handler that may be shared between threads
+    
+    Each request checks a connection out of the shared pool. Instead of
+    raising CannotSendRequest, a request waits while "max_per_host"
+    connections to its host are busy. Responses closed by another thread
+    are noticed every "poll_interval" seconds."""
+    
+    poll_interval = 0.1
+    
+    def __init__(self, *pos, **kw):
+        self._local = threading.local()
+        self._lock = threading.Condition()
+        PooledConnectionHandler.__init__(self, *pos, **kw)
+    
+    # Connection and pool key of the calling thread's current request
+    @property
+    def _connection(self):
+        return getattr(self._local, "connection", None)
+    @_connection.setter
+    def _connection(self, connection):
+        self._local.connection = connection
+    
+    @property
+    def _key(self):
+        return getattr(self._local, "key", None)
+    @_key.setter
+    def _key(self, key):
+        self._local.key = key
+    
+    def _checkout(self, *pos, **kw):
+        with self._lock:
+            while True:
+                try:
+                    return PooledConnectionHandler._checkout(self,
+                        *pos, **kw)
+                except http.client.CannotSendRequest:
+                    self._lock.wait(self.poll_interval)
+    
+    def _track(self, response):
+        with self._lock:
+            PooledConnectionHandler._track(self, response)
+            if response.isclosed():
+                self._lock.notify_all()
+    
+    def _discard(self, connection):
+        with self._lock:
+            PooledConnectionHandler._discard(self, connection)
+            self._lock.notify_all()
+    
+    def close(self):
+        with self._lock:
+            PooledConnectionHandler.close(self)
+
+def fetch_many(urls, workers=4, *, window=None, handler=None, **kw):
+    """Fetch URLs concurrently using a pool of threads
+    
+    Yields (url, response, body) tuples in the order that the fetches
+    complete. Other keyword arguments are passed to http_request(). An
+    exception from a fetch is raised from the generator, and fetches that
+    have not started are cancelled. By default, connections are shared
+    through a ThreadedConnectionHandler, which is closed at the end.
+    
+    URLs are taken from "urls" as results are consumed, so that at most
+    "window" fetches (default twice "workers") are pending or holding
+    bodies at once."""
+    
+    with ExitStack() as cleanup:
+        if handler is None:
+            handler = ThreadedConnectionHandler(max_per_host=workers)
+            cleanup.enter_context(handler)
+        urlopen = urllib.request.build_opener(handler).open
+        executor = cleanup.enter_context(ThreadPoolExecutor(workers))
+        
+        def fetch(url):
+            with http_request(url, urlopen=urlopen, **kw) as response:
+                return (response, response.read())
+        if window is None:
+            window = workers * 2
+        urls = iter(urls)
+        pending = dict()  # {future: url}
+        try:
+            while True:
+                for url in islice(urls, window - len(pending)):
+                    pending[executor.submit(fetch, url)] = url
+                if not pending:
+                    break
+                [done, _] = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    url = pending.pop(future)
+                    [response, body] = future.result()
+                    yield (url, response, body)
+        finally:
+            for future in pending:
+                future.cancel()
+
 def http_request(url, types=None, *,
         urlopen=urllib.request.urlopen, headers=(), **kw):
     headers = dict(headers)
@@ -330,7 +868,709 @@ def http_request(url, types=None, *,
         response.close()
         raise
 
+class HttpCache(Context):
+    """Index of cached HTTP responses
+    
+    The index is an SQLite database in the root directory, mapping each
+    request to its response header, body file, expiry time and last access
+    time. Body files are stored under the root directory according to the
+    URL. Bodies from request_cached() versions without an index, described
+    by ".mime" files, are added to the index when they are looked up.
+    
+    Responses are fresh until the time given by "Cache-Control: max-age"
+    or "Expires", or for "default_lifetime" seconds if neither is given
+    (forever by default). When "max_size" is given, the least recently
+    used bodies are removed once the total size of the bodies exceeds it.
+    
+    Setting "memory_entries" enables an in-memory tier holding parsed
+    headers of up to that many recently used entries, along with bodies up
+    to "memory_body_limit" bytes, and up to "memory_bytes" in total. The
+    "stats" counter records "hits" and "misses" of the index, and
+    "memory_hits" and "memory_misses" of the memory tier.
+    
+    Bodies without a Content-Encoding are compressed on disk if "codec"
+    names one of CODECS, at the given "level" (or the codec's default).
+    They are decompressed again when read back. If "dedup" is set, bodies
+    are stored under "http-cache.objects" by the SHA-256 of their content,
+    so that identical bodies share a file.
+    """
+    
+    INDEX = "http-cache.sqlite"
+    LOCKS = "http-cache.locks"  # Directory of lock files for fill()
+    TEMPS = "http-cache.temp"  # Directory of bodies being written
+    TEMP_SUFFIX = ".http-cache.part"
+    OBJECTS = "http-cache.objects"  # Directory of deduplicated bodies
+    
+    # {name: (extension, open(file, level) for writing, open(path))}
+    CODECS = {
+        "gzip": (".gz",
+            lambda file, level: GzipFile(fileobj=file, mode="wb",
+                compresslevel=9 if level is None else level, mtime=0),
+            partial(GzipFile, mode="rb")),
+        "zlib": (".zz",
+            lambda file, level: _ZlibWriter(file,
+                zlib.Z_DEFAULT_COMPRESSION if level is None else level),
+            lambda path: _ZlibDecoder(open(path, "rb"))),
+        "lzma": (".xz",
+            lambda file, level: lzma.LZMAFile(file, "wb", preset=level),
+            partial(lzma.open, mode="rb")),
+    }
+    fill_timeout = 600
+    
+    def __init__(self, root=os.curdir, *,
+            max_size=None, default_lifetime=None,
+            memory_entries=0, memory_bytes=0x1000000,
+            memory_body_limit=0x10000,
+            codec=None, level=None, dedup=False):
+        if codec is not None and codec not in self.CODECS:
+            raise ValueError("Unknown codec: " + repr(codec))
+        self.root = root
+        self.codec = codec
+        self.level = level
+        self.dedup = dedup
+        self.max_size = max_size
+        self.default_lifetime = default_lifetime
+        self.memory_entries = memory_entries
+        self.memory_bytes = memory_bytes
+        self.memory_body_limit = memory_body_limit
+        self.stats = Counter()
+        self._memory = OrderedDict()  # {key: _MemoryEntry}
+        self._memory_size = 0
+        self._touched = dict()  # {key: access time not yet in index}
+        self._lock = threading.RLock()
+        self._filling = dict()  # {key: thread storing it}
+        self._fill_done = threading.Condition(self._lock)
+        self._db = sqlite3.connect(os.path.join(root, self.INDEX),
+            check_same_thread=False, isolation_level=None)
+        # Avoid a disk sync for every update of an access time
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            body TEXT NOT NULL,  -- Relative to root
+            header BLOB NOT NULL,
+            size INTEGER,
+            expires REAL,  -- NULL means never
+            accessed REAL NOT NULL,
+            codec TEXT  -- NULL means not compressed
+        )""")
+        columns = self._db.execute("PRAGMA table_info(entries)")
+        if "codec" not in {column[1] for column in columns}:
+            self._db.execute("ALTER TABLE entries ADD COLUMN codec TEXT")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS lru
+            ON entries (accessed)""")
+        self._db.execute("""CREATE INDEX IF NOT EXISTS bodies
+            ON entries (body)""")
+        # Count each body file once, even if shared by entries
+        [self._total] = self._db.execute("""SELECT TOTAL(size)
+            FROM (SELECT DISTINCT body, size FROM entries)""").fetchone()
+        self._closing = threading.Event()
+        self._sweeper = threading.Thread(target=self.sweep, daemon=True)
+        self._sweeper.start()
+    
+    def lookup(self, key, legacy=None, *, count=True):
+        """Return CacheEntry for "key", or None if missing
+        
+        The "legacy" parameter may name a ".mime" file, relative to the
+        root, to import if the key is not in the index. If "count" is
+        false, the lookup is not recorded in "stats"."""
+        
+        stats = self.stats if count else Counter()
+        with self._lock:
+            memory = self._memory.get(key)
+            if memory is not None:
+                self._memory.move_to_end(key)
+                stats["memory_hits"] += 1
+                return memory.entry
+            if self.memory_entries:
+                stats["memory_misses"] += 1
+            
+            row = self._db.execute("""SELECT
+                body, header, size, expires, codec
+                FROM entries WHERE key = ?""", (key,)).fetchone()
+            if row is None:
+                entry = None
+                if legacy is not None:
+                    entry = self._import(key, legacy)
+            else:
+                entry = CacheEntry(*row)
+                # Size is missing for bodies left incomplete by versions
+                # that wrote bodies in place
+                if (entry.size is None
+                        or not os.path.exists(self.path(entry.body))):
+                    self._remove(key)
+                    entry = None
+            stats["misses" if entry is None else "hits"] += 1
+            return entry
+    
+    def open(self, key, entry):
+        """Return (header, body file) for an entry, and record its use
+        
+        The header Message may be shared with other callers, so it should
+        not be modified."""
+        
+        with self._lock:
+            self.touch(key)
+            memory = self._memory.get(key)
+        if memory is not None:
+            if memory.body is not None:
+                return (memory.header, BytesIO(memory.body))
+            header = memory.header
+        else:
+            header = email.message_from_bytes(entry.header)
+        file = self.open_body(entry)
+        if memory is not None or not self.memory_entries:
+            return (header, file)
+        
+        body = None
+        if entry.size is not None and entry.size <= self.memory_body_limit:
+            # A compressed body may expand beyond the limit
+            limit = self.memory_body_limit
+            output = BytesIO()
+            with file:
+                copied = pump(file, output, length=limit + 1).copied
+            if copied > limit:
+                file = self.open_body(entry)
+            else:
+                body = output.getvalue()
+                file = BytesIO(body)
+        with self._lock:
+            self._remember(key, _MemoryEntry(entry, header, body))
+        return (header, file)
+    
+    def open_body(self, entry):
+        """Open an entry's body file, decompressing it if necessary"""
+        path = self.path(entry.body)
+        if entry.codec is None:
+            return open(path, "rb")
+        [ext, writer, reader] = self.CODECS[entry.codec]
+        return reader(path)
+    
+    def send_body(self, key, entry, sock):
+        """Send an entry's body to a socket, and record its use
+        
+        Returns the number of bytes sent. Uncompressed bodies are sent
+        with os.sendfile() where possible; see send_file()."""
+        
+        [header, file] = self.open(key, entry)
+        with file:
+            return send_file(sock, file)
+    
+    def _remember(self, key, memory):
+        self._forget(key)
+        self._memory[key] = memory
+        self._memory_size += memory.size()
+        while (len(self._memory) > self.memory_entries or
+        self._memory_size > self.memory_bytes):
+            [_, memory] = self._memory.popitem(last=False)
+            self._memory_size -= memory.size()
+    
+    def _forget(self, key):
+        memory = self._memory.pop(key, None)
+        if memory is not None:
+            self._memory_size -= memory.size()
+    
+    def _import(self, key, legacy):
+        try:
+            metadata = open(self.path(legacy), "rb")
+        except FileNotFoundError:
+            return None
+        with metadata:
+            msg = email.message_from_binary_file(metadata)
+        body = os.path.join(os.path.dirname(legacy), msg.get_param("name"))
+        [header] = msg.get_payload()
+        header = header.as_bytes()
+        try:
+            size = os.path.getsize(self.path(body))
+        except FileNotFoundError:
+            return None
+        self._db.execute("""INSERT INTO entries
+            (key, body, header, size, expires, accessed)
+            VALUES (?, ?, ?, ?, NULL, ?)""",
+            (key, body, header, size, time.time()))
+        self._total += size
+        self._evict()
+        return CacheEntry(body, header, size, None, None)
+    
+    def touch(self, key):
+        """Record that an entry has been used
+        
+        Access times are written to the index in batches."""
+        
+        with self._lock:
+            self._touched[key] = time.time()
+            if len(self._touched) >= 1000:
+                self._flush()
+    
+    def _flush(self):
+        self._db.executemany("UPDATE entries SET accessed = ? WHERE key = ?",
+            ((accessed, key) for [key, accessed] in self._touched.items()))
+        self._touched.clear()
+    
+    def revalidated(self, key, entry, header):
+        """Update an entry after a "304 Not Modified" response
+        
+        Returns the updated header Message."""
+        
+        stored = email.message_from_bytes(entry.header)
+        uncached = set(UNCACHED_FIELDS)
+        uncached.update(field.lower()
+            for field in header_list(header, "Connection"))
+        fields = {field.lower(): field for field in header.keys()}
+        for [name, field] in fields.items():
+            if name in uncached:
+                continue
+            del stored[field]
+            for value in header.get_all(field):
+                stored[field] = value
+        with self._lock:
+            self._forget(key)
+            self._touched.pop(key, None)
+            self._db.execute("""UPDATE entries
+                SET header = ?, expires = ?, accessed = ? WHERE key = ?""",
+                (stored.as_bytes(), self.expiry(stored), time.time(), key))
+        return stored
+    
+    def fill(self, key):
+        """Claim the right to fetch and store a response
+        
+        Waits while another thread, or another process using the same
+        root, has claimed the same key. Returns a _Fill object with a
+        "waited" attribute, which should be released once the response is
+        stored or abandoned. Returns None if the calling thread already
+        holds the claim, or if waiting takes longer than "fill_timeout"
+        seconds; the response should then not be stored."""
+        
+        thread = threading.get_ident()
+        deadline = time.monotonic() + self.fill_timeout
+        waited = False
+        with self._fill_done:
+            while key in self._filling:
+                if self._filling[key] == thread:
+                    return None
+                waited = True
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    return None
+                self._fill_done.wait(timeout)
+            self._filling[key] = thread
+        fill = _Fill(self, key, waited)
+        
+        # Lock file shared with other processes
+        try:
+            path = self.path(os.path.join(self.LOCKS, key))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            while True:
+                try:
+                    os.close(os.open(path, os.O_CREAT | os.O_EXCL))
+                    break
+                except FileExistsError:
+                    fill.waited = True
+                try:
+                    age = time.time() - os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                if age > self.fill_timeout:  # Left by a crashed process
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if time.monotonic() > deadline:
+                    fill.release()
+                    return None
+                time.sleep(0.05)
+        except:
+            fill.release()
+            raise
+        fill.path = path
+        return fill
+    
+    def store(self, key, body, header, fill=None, length=None):
+        """Start storing a response body
+        
+        The "body" parameter is the file name relative to the root. Returns
+        a writable file object, which should be closed when the body is
+        complete. Closing it also releases any "fill" claim from fill().
+        
+        The body is written to a temporary file in "http-cache.temp", and
+        only replaces any existing entry when the writer is closed after the
+        complete body was written. The body is complete if its size matches
+        "length", or if "length" is None, after an empty write marks the
+        end. Otherwise the temporary file is discarded."""
+        
+        codec = None
+        if not any(header_list(header, "Content-Encoding")):
+            codec = self.codec
+        if codec is not None:
+            body += self.CODECS[codec][0]
+        temps = self.path(self.TEMPS)
+        os.makedirs(temps, exist_ok=True)
+        name = os.path.basename(body)
+        [fd, temp] = tempfile.mkstemp(self.TEMP_SUFFIX, name + ".", temps)
+        file = open(fd, "wb")
+        entry = [key, body, header.as_bytes(), self.expiry(header), codec,
+            temp]
+        return _CacheWriter(self, file, fill, length, entry)
+    
+    def _stored(self, key, body, header, expires, codec, temp, digest):
+        size = os.path.getsize(temp)
+        with self._lock:
+            self._remove(key)
+            if digest is not None:
+                ext = "" if codec is None else self.CODECS[codec][0]
+                body = os.path.join(self.OBJECTS, digest[:2], digest + ext)
+            if digest is not None and self._shared(body):
+                os.remove(temp)
+            else:
+                path = self.path(body)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(temp, path)
+                self._total += size
+            self._db.execute("""INSERT INTO entries
+                (key, body, header, size, expires, accessed, codec)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (key, body, header, size, expires, time.time(), codec))
+            self._evict()
+    
+    def _shared(self, body):
+        """Check if any entry refers to a body file"""
+        row = self._db.execute("SELECT 1 FROM entries WHERE body = ?",
+            (body,)).fetchone()
+        return row is not None and os.path.exists(self.path(body))
+    
+    def sweep(self):
+        """Remove temporary and lock files abandoned by other writers
+        
+        Only the "http-cache.temp" and "http-cache.locks" directories are
+        searched, and only files older than "fill_timeout" are removed.
+        This is run in the background when the cache is opened."""
+        
+        cutoff = time.time() - self.fill_timeout
+        for dir in (self.LOCKS, self.TEMPS):
+            try:
+                files = os.scandir(self.path(dir))
+            except FileNotFoundError:
+                continue
+            with files:
+                for file in files:
+                    if self._closing.is_set():
+                        return
+                    try:
+                        if file.stat().st_mtime < cutoff:
+                            os.remove(file.path)
+                            self.stats["swept"] += 1
+                    except FileNotFoundError:
+                        pass
+    
+    def _evict(self):
+        if self.max_size is None or self._total <= self.max_size:
+            return
+        self._flush()
+        lru = self._db.execute("""SELECT key FROM entries
+            WHERE size IS NOT NULL ORDER BY accessed""").fetchall()
+        for [key] in lru:
+            if self._total <= self.max_size:
+                break
+            self._remove(key)
+    
+    def _remove(self, key):
+        row = self._db.execute("SELECT body, size FROM entries WHERE key = ?",
+            (key,)).fetchone()
+        if row is None:
+            return
+        [body, size] = row
+        self._forget(key)
+        self._touched.pop(key, None)
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        if self._shared(body):
+            return
+        if size is not None:
+            self._total -= size
+        try:
+            os.remove(self.path(body))
+        except FileNotFoundError:
+            pass
+    
+    def path(self, name):
+        return os.path.join(self.root, name)
+    
+    def expiry(self, header, now=None):
+        """Return the time when a response becomes stale, or None if never
+        
+        Raises ValueError if the response should not be stored."""
+        
+        if now is None:
+            now = time.time()
+        max_age = None
+        for directive in header_list(header, "Cache-Control"):
+            [directive, value] = header_partition(directive, "=")
+            directive = directive.lower()
+            if directive == "no-store":
+                raise ValueError("Response not to be stored")
+            if directive == "no-cache":
+                return now
+            if directive == "max-age":
+                try:
+                    max_age = int(header_unquote(value))
+                except ValueError:
+                    return now  # Invalid value means stale
+        if max_age is None:
+            expires = header.get("Expires")
+            if expires is not None:
+                date = _parse_date(header.get("Date"), now)
+                return now + _parse_date(expires, 0) - date
+            if self.default_lifetime is None:
+                return None
+            max_age = self.default_lifetime
+        age = header.get("Age", "")
+        age = int(age) if age.isdigit() else 0
+        return now + max_age - age
+    
+    def close(self):
+        self._closing.set()
+        self._sweeper.join()
+        with self._lock:
+            self._flush()
+            self._db.close()
+
+class CacheEntry(namedtuple("CacheEntry",
+        "body, header, size, expires, codec")):
+    def fresh(self, now):
+        return self.expires is None or now < self.expires
+
+class _MemoryEntry(namedtuple("_MemoryEntry", "entry, header, body")):
+    def size(self):
+        size = len(self.entry.header)
+        if self.body is not None:
+            size += len(self.body)
+        return size
+
+# Header fields describing the connection rather than the response
+UNCACHED_FIELDS = frozenset(field.lower() for field in (
+    "Close", "Connection", "Keep-Alive",
+    "Proxy-Authenticate", "Proxy-Authorization",
+    "Public",
+    "Transfer-Encoding", "TE", "Trailer",
+    "Upgrade",
+))
+
+def _parse_date(date, default):
+    try:
+        return email.utils.parsedate_to_datetime(date).timestamp()
+    except (TypeError, ValueError):
+        return default
+
+class _Fill:
+    def __init__(self, cache, key, waited):
+        self._cache = cache
+        self._key = key
+        self.waited = waited
+        self.path = None
+    
+    def release(self):
+        """Release the claim; does nothing if already released"""
+        if self._key is None:
+            return
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+        with self._cache._fill_done:
+            del self._cache._filling[self._key]
+            self._cache._fill_done.notify_all()
+        self._key = None
+
+class _CacheWriter(BufferedIOBase):
+    """Writes a body to the cache, and records it when closed"""
+    
+    def __init__(self, cache, file, fill, length, entry):
+        self._cache = cache
+        self._file = file
+        self._fill = fill
+        self._length = length
+        self._entry = entry
+        self._size = 0
+        self._eof = False
+        
+        self._encoder = None
+        codec = entry[-2]
+        if codec is not None:
+            [ext, writer, reader] = cache.CODECS[codec]
+            self._encoder = writer(file, cache.level)
+        self._hash = None
+        if cache.dedup:
+            # Bodies are only shared between entries using the same codec
+            self._hash = hashlib.sha256(format(codec).encode() + b"\0")
+    
+    def writable(self):
+        return True
+    
+    def write(self, b):
+        if self._encoder is None:
+            n = self._file.write(b)
+        else:
+            n = self._encoder.write(b)
+        if self._hash is not None:
+            self._hash.update(b)
+        self._size += n
+        if not n:
+            self._eof = True
+        return n
+    
+    def close(self):
+        if self.closed:
+            return
+        temp = self._entry[-1]
+        try:
+            try:
+                if self._encoder is not None:
+                    self._encoder.close()
+            finally:
+                self._file.close()
+            if self._length is None:
+                complete = self._eof
+            else:
+                complete = self._size == self._length
+            if complete:
+                digest = None
+                if self._hash is not None:
+                    digest = self._hash.hexdigest()
+                self._cache._stored(*self._entry, digest)
+            else:
+                os.remove(temp)
+                self._cache.stats["incomplete"] += 1
+        except:
+            try:
+                os.remove(temp)
+            except FileNotFoundError:
+                pass
+            raise
+        finally:
+            if self._fill is not None:
+                self._fill.release()
+            BufferedIOBase.close(self)
+
+class _ZlibWriter(BufferedIOBase):
+    """Compresses to a file in zlib format; the file is left open"""
+    
+    def __init__(self, file, level):
+        self._file = file
+        self._compressor = zlib.compressobj(level)
+    
+    def writable(self):
+        return True
+    
+    def write(self, b):
+        self._file.write(self._compressor.compress(b))
+        with memoryview(b) as view:
+            return view.nbytes
+    
+    def close(self):
+        if not self.closed:
+            self._file.write(self._compressor.flush())
+        BufferedIOBase.close(self)
+
+class _ZlibDecoder(Reader):
+    """Decompresses data from a file, and closes the file
+    
+    The "wbits" parameter is as for zlib.decompressobj(), or None to
+    detect the zlib format or raw deflate data, as both are sent for
+    "Content-Encoding: deflate". Concatenated gzip members are all
+    decoded."""
+    
+    BLOCK_SIZE = 0x10000
+    
+    def __init__(self, file, wbits=zlib.MAX_WBITS):
+        self._file = file
+        self._read = getattr(file, "read1", file.read)
+        self._wbits = wbits
+        self._decompressor = None
+        self._data = b""  # Compressed data not yet passed on
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(partial(self.read, self.BLOCK_SIZE), b""))
+        if not size:
+            return b""
+        while True:
+            if not self._data:
+                self._data = self._read(self.BLOCK_SIZE)
+            if self._decompressor is None or self._decompressor.eof:
+                if not self._start():
+                    return b""
+            input = self._data
+            data = self._decompressor.decompress(input, size)
+            if self._decompressor.eof:
+                self._data = self._decompressor.unused_data
+            else:
+                self._data = self._decompressor.unconsumed_tail
+            if data:
+                return data
+            if not input and not self._decompressor.eof:
+                raise EOFError("Compressed data ended before the "
+                    "end-of-stream marker")
+    
+    read1 = read
+    
+    def readinto(self, b):
+        with memoryview(b) as view, view.cast("B") as bytes:
+            data = self.read(len(bytes))
+            bytes[:len(data)] = data
+        return len(data)
+    
+    readinto1 = readinto
+    
+    def _start(self):
+        """Set up decompression of the next stream, if any"""
+        if not self._data:
+            return False
+        wbits = self._wbits
+        if self._decompressor is not None and wbits != GZIP_WBITS:
+            return False  # Only gzip has multiple members
+        if wbits is None:
+            data = self._data
+            zlib_format = (len(data) >= 2 and data[0] & 0x0F == 8
+                and (data[0] << 8 | data[1]) % 31 == 0)
+            wbits = zlib.MAX_WBITS if zlib_format else -zlib.MAX_WBITS
+        self._decompressor = zlib.decompressobj(wbits)
+        return True
+    
+    def close(self):
+        self._file.close()
+        Reader.close(self)
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# {Content-Encoding: _ZlibDecoder "wbits" parameter}
+CONTENT_DECODERS = {"gzip": GZIP_WBITS, "x-gzip": GZIP_WBITS, "deflate": None}
+
+def default_cache():
+    """Return an HttpCache for the current directory
+    
+    The cache is closed at exit, saving any pending access times."""
+    
+    root = os.path.abspath(os.curdir)
+    with _default_caches_lock:
+        cache = _default_caches.get(root)
+        if cache is None:
+            cache = HttpCache(root)
+            _default_caches[root] = cache
+            atexit.register(cache.close)
+        return cache
+
+_default_caches = dict()
+_default_caches_lock = threading.Lock()
+
 def request_cached(url, msg=None, *, cache=True, cleanup, **kw):
+    """Make an HTTP request, using a cache for the response
+    
+    The "cache" parameter may be an HttpCache object, True to use
+    default_cache(), or False to bypass caching. Returns (header, response)
+    tuple. Stale cached responses are revalidated with a conditional
+    request if they have an ETag or Last-Modified field."""
+    
     if msg is None:
         msg = url
     data = kw.get('data')
@@ -339,99 +1579,145 @@ def request_cached(url, msg=None, *, cache=True, cleanup, **kw):
         method = 'GET' if data is None else 'POST'
     print(method, msg, end=" ", flush=True, file=sys.stderr)
     
-    try:
-        if not cache:
-            raise FileNotFoundError()
-        path = url[:100].split("/")
-        dir = os.path.join(*path[:-1])
-        suffix = hashlib.md5()
-        if method not in {'GET', 'HEAD'}:
-            suffix.update(method.encode('ascii'))
-        suffix.update(url.encode())
-        if data is not None:
-            suffix.update(data)
-        suffix = suffix.digest()[:6]
-        suffix = urlsafe_b64encode(suffix).decode("ascii")
-        print(suffix, end=' ', file=sys.stderr)
-        
-        if path[-1]:
-            suffix = path[-1] + os.extsep + suffix
-        metadata = os.path.join(dir, suffix + os.extsep + "mime")
-        metadata = open(metadata, "rb")
-    except FileNotFoundError:
+    if not cache:
         response = http_request(url, **kw)
         cleanup.enter_context(response)
         print(response.status, response.reason, flush=True,
             file=sys.stderr)
-        
-        header = response.info()
-        if cache:
-            for field in header_list(header, "Connection"):
-                del header[field]
-            for field in (
-                "Close", "Connection", "Keep-Alive",
-                "Proxy-Authenticate", "Proxy-Authorization",
-                "Public",
-                "Transfer-Encoding", "TE", "Trailer",
-                "Upgrade",
-            ):
-                del header[field]
-            
-            default = (('application/octet-stream', None),)
-            [type, value] = header.get_params(default)[0]
-            if type != 'application/octet-stream':
-                ext = {
-                    'text/html': 'html', 'text/javascript': 'js',
-                    'application/json': 'json',
-                    'audio/mpeg': 'mpga',
-                    'image/jpeg': 'jpeg',
-                }.get(type)
-                if ext is None:
-                    suffix += mimetypes.guess_extension(type, strict=False)
-                else:
-                    suffix += os.extsep + ext
-            for encoding in header_list(header, "Content-Encoding"):
-                if encoding.lower() in {"gzip", "x-gzip"}:
-                    suffix += os.extsep + "gz"
-                    break
-            os.makedirs(dir, exist_ok=True)
-            cache = open(os.path.join(dir, suffix), "xb")
-            cleanup.enter_context(cache)
-            msg = Message()
-            msg.add_header("Content-Type",
-                "message/external-body; access-type=local-file",
-                name=suffix)
-            header.add_header('Status',
-                '{} {}'.format(response.status, response.reason))
-            msg.attach(header)
-            with open(metadata, "xb") as metadata:
-                metadata = email.generator.BytesGenerator(metadata,
-                    mangle_from_=False, maxheaderlen=0)
-                metadata.flatten(msg)
-            response = TeeReader(response, cache.write)
+        return (response.info(), response)
+    if cache is True:
+        cache = default_cache()
+    
+    path = url[:100].split("/")
+    dir = os.path.join(*path[:-1])
+    key = hashlib.md5()
+    if method not in {'GET', 'HEAD'}:
+        key.update(method.encode('ascii'))
+    key.update(url.encode())
+    if data is not None:
+        key.update(data)
+    suffix = urlsafe_b64encode(key.digest()[:6]).decode("ascii")
+    key = key.hexdigest()
+    print(suffix, end=' ', file=sys.stderr)
+    if path[-1]:
+        suffix = path[-1] + os.extsep + suffix
+    
+    legacy = os.path.join(dir, suffix + os.extsep + "mime")
+    entry = cache.lookup(key, legacy)
+    if entry is not None and entry.fresh(time.time()):
+        [header, response] = cache.open(key, entry)
+        cleanup.enter_context(response)
+        print("(cached)", flush=True, file=sys.stderr)
+        return (header, response)
+    
+    fill = cache.fill(key)
+    try:
+        if fill is not None:
+            # Another caller may have stored the response since the first
+            # lookup, possibly while this one waited for the claim
+            entry = cache.lookup(key, legacy, count=fill.waited)
+            if entry is not None and entry.fresh(time.time()):
+                fill.release()
+                [header, response] = cache.open(key, entry)
+                cleanup.enter_context(response)
+                print("(cached)", flush=True, file=sys.stderr)
+                return (header, response)
+        return _fill_cache(cache, key, entry, fill, url, dir, suffix,
+            cleanup=cleanup, **kw)
+    except:
+        if fill is not None:
+            fill.release()
+        raise
+
+def _fill_cache(cache, key, entry, fill, url, dir, suffix, *,
+        cleanup, headers=(), **kw):
+    headers = dict(headers)
+    if entry is not None:
+        stored = email.message_from_bytes(entry.header)
+        etag = stored.get("ETag")
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        modified = stored.get("Last-Modified")
+        if modified is not None:
+            headers["If-Modified-Since"] = modified
+    try:
+        response = http_request(url, headers=headers, **kw)
+    except urllib.error.HTTPError as err:
+        if entry is None or err.code != http.client.NOT_MODIFIED:
+            raise
+        err.close()
+        print(err.code, err.reason, "(revalidated)", flush=True,
+            file=sys.stderr)
+        header = cache.revalidated(key, entry, err.info())
+        if fill is not None:
+            fill.release()
+        response = cleanup.enter_context(cache.open_body(entry))
         return (header, response)
-    with metadata:
-        msg = email.message_from_binary_file(metadata)
-    cache = os.path.join(dir, msg.get_param("name"))
-    [msg] = msg.get_payload()
-    response = cleanup.enter_context(open(cache, "rb"))
-    print("(cached)", flush=True, file=sys.stderr)
-    return (msg, response)
+    cleanup.enter_context(response)
+    print(response.status, response.reason, flush=True, file=sys.stderr)
+    
+    header = response.info()
+    for field in header_list(header, "Connection"):
+        del header[field]
+    for field in UNCACHED_FIELDS:
+        del header[field]
+    try:
+        if fill is None:
+            raise ValueError("Entry being stored by another caller")
+        cache.expiry(header)
+    except ValueError:  # Not to be stored
+        if fill is not None:
+            fill.release()
+        return (header, response)
+    
+    default = (('application/octet-stream', None),)
+    [type, value] = header.get_params(default)[0]
+    if type != 'application/octet-stream':
+        ext = {
+            'text/html': 'html', 'text/javascript': 'js',
+            'application/json': 'json',
+            'audio/mpeg': 'mpga',
+            'image/jpeg': 'jpeg',
+        }.get(type)
+        if ext is None:
+            ext = mimetypes.guess_extension(type, strict=False)
+            if ext is not None:
+                suffix += ext
+        else:
+            suffix += os.extsep + ext
+    for encoding in header_list(header, "Content-Encoding"):
+        if encoding.lower() in {"gzip", "x-gzip"}:
+            suffix += os.extsep + "gz"
+            break
+    header.add_header('Status',
+        '{} {}'.format(response.status, response.reason))
+    length = header.get("Content-Length")
+    if length is not None:
+        length = int(length) if length.isdigit() else -1
+    writer = cache.store(key, os.path.join(dir, suffix), header, fill,
+        length)
+    cleanup.enter_context(writer)
+    response = TeeReader(response, writer.write)
+    return (header, response)
 
 def request_decoded(*pos, headers=(), **kw):
     headers += (
-        ("Accept-Encoding", "gzip, x-gzip"),
+        ("Accept-Encoding", ", ".join(CONTENT_DECODERS)),
     )
     [header, response] = request_cached(*pos, headers=headers, **kw)
     
-    for encoding in header_list(header, "Content-Encoding"):
-        if encoding.lower() in {"gzip", "x-gzip"}:
-            if isinstance(response, GzipFile):
-                raise TypeError("Recursive gzip encoding")
-            response = GzipFile(fileobj=response, mode="rb")
-        else:
+    # The last encoding listed was applied last
+    encodings = list(header_list(header, "Content-Encoding"))
+    for encoding in reversed(encodings):
+        encoding = encoding.lower()
+        if encoding == "identity":
+            continue
+        try:
+            wbits = CONTENT_DECODERS[encoding]
+        except LookupError:
             msg = "Unhandled encoding: " + repr(encoding)
             raise TypeError(msg)
+        response = _ZlibDecoder(response, wbits)
     return (header, response)
 
 def request_text(*pos, errors=None, **kw):
@@ -1,6 +1,12 @@
 from io import BufferedIOBase, IOBase
 from functions import instantiated
-from io import UnsupportedOperation
+from io import UnsupportedOperation, FileIO
+from socket import SocketIO
+import os
+import errno
+import selectors
+import time
+from collections import namedtuple
 
 class Reader(BufferedIOBase):
     def detatch(self):
@@ -45,15 +51,162 @@ class DelegateWriter(IOBase):
             write(x)
         return len(x)
 
-def streamcopy(input, output, length):
+def streamcopy(input, output, length, *, block=0x10000, on_progress=None):
+    """Copy exactly "length" bytes, raising EOFError if the input ends early
+    
+    Data is read into one buffer of up to "block" bytes, which is reused,
+    so the output should not keep references to what is passed to its
+    write() method. If both files have descriptors and the input is
+    seekable, the kernel copies the data with os.copy_file_range() or
+    os.sendfile() where possible. If given, on_progress() is called with
+    the total number of bytes copied so far after each step."""
+    
     if length < 0:
         raise ValueError("Negative length")
-    while length:
-        chunk = input.read(min(length, 0x10000))
-        if not chunk:
-            raise EOFError()
-        output.write(chunk)
-        length -= len(chunk)
+    if _copy(input, output, length, block, on_progress) < length:
+        raise EOFError()
+
+PumpResult = namedtuple("PumpResult", "copied, elapsed, rate")
+
+def pump(input, output, *, length=None, block=0x10000, on_progress=None):
+    """Copy until the end of the input, or up to "length" bytes
+    
+    Copies like streamcopy(), but the input may end early. Returns a
+    PumpResult with the number of bytes copied, the elapsed time in
+    seconds, and the rate in bytes per second (None if no time was
+    measured). If the output is a CounterWriter, the copy bypasses it, so
+    that descriptors can still be used, and its count is updated at the
+    end."""
+    
+    if length is not None and length < 0:
+        raise ValueError("Negative length")
+    counter = None
+    if isinstance(output, CounterWriter):
+        counter = output
+        output = counter.output
+    start = time.monotonic()
+    try:
+        copied = _copy(input, output, length, block, on_progress)
+    finally:
+        elapsed = time.monotonic() - start
+    if counter is not None:
+        counter.length += copied
+    rate = copied / elapsed if elapsed > 0 else None
+    return PumpResult(copied, elapsed, rate)
+
+def _copy(input, output, length, block, on_progress):
+    """Returns the number of bytes copied, less than "length" at EOF
+    
+    If "length" is None, copies until EOF."""
+    
+    [copied, eof] = _copy_descriptors(input, output, length, on_progress)
+    if eof or copied == length:
+        return copied
+    
+    readinto = getattr(input, "readinto", None)
+    size = block
+    if length is not None:
+        size = min(length - copied, block)
+    buffer = bytearray(size)
+    with memoryview(buffer) as view:
+        while length is None or copied < length:
+            if length is not None:
+                size = min(length - copied, block)
+            if readinto is None:
+                chunk = input.read(size)
+                n = len(chunk)
+            else:
+                chunk = view[:readinto(view[:size])]
+                n = chunk.nbytes
+            if not n:
+                break
+            output.write(chunk)
+            copied += n
+            if on_progress is not None:
+                on_progress(copied)
+    return copied
+
+def _copy_descriptors(input, output, length, on_progress):
+    """Try copying between file descriptors
+    
+    Returns (copied, eof). Nothing is copied if the files are not
+    suitable."""
+    
+    # Wrappers such as GzipFile return the descriptor of the underlying
+    # file, so only use files known to read or write their descriptor
+    if not isinstance(getattr(input, "raw", input), FileIO):
+        return (0, False)
+    if not isinstance(getattr(output, "raw", output), (FileIO, SocketIO)):
+        return (0, False)
+    try:
+        infd = input.fileno()
+        outfd = output.fileno()
+        offset = input.tell()
+    except OSError:  # Including io.UnsupportedOperation
+        return (0, False)
+    output.flush()
+    
+    copied = 0
+    eof = False
+    try:
+        for copy in _DESCRIPTOR_COPIES:
+            try:
+                while length is None or copied < length:
+                    count = _MAX_COPY
+                    if length is not None:
+                        count = min(length - copied, count)
+                    try:
+                        n = copy(outfd, infd, offset + copied, count)
+                    except BlockingIOError:
+                        _wait_writable(output, outfd)
+                        continue
+                    if not n:
+                        eof = True
+                        break
+                    copied += n
+                    if on_progress is not None:
+                        on_progress(copied)
+                break
+            except OSError as err:
+                if err.errno not in _UNSUPPORTED_COPY_ERRNOS:
+                    raise
+    finally:
+        input.seek(offset + copied)
+    if copied and output.seekable():
+        output.seek(0, os.SEEK_CUR)  # Update position after writing to fd
+    return (copied, eof)
+
+_MAX_COPY = 0x7FFFF000  # Most Linux transfers at once
+
+def _wait_writable(output, fd):
+    """Wait for a non-blocking descriptor, such as a socket with a timeout
+    
+    Raises TimeoutError after the socket's timeout."""
+    
+    sock = getattr(getattr(output, "raw", output), "_sock", None)
+    timeout = None if sock is None else sock.gettimeout()
+    with selectors.DefaultSelector() as selector:
+        selector.register(fd, selectors.EVENT_WRITE)
+        if not selector.select(timeout):
+            raise TimeoutError("timed out")
+
+def _copy_file_range(outfd, infd, offset, count):
+    return os.copy_file_range(infd, outfd, count, offset)
+
+def _sendfile(outfd, infd, offset, count):
+    return os.sendfile(outfd, infd, offset, count)
+
+_DESCRIPTOR_COPIES = list()
+if hasattr(os, "copy_file_range"):
+    _DESCRIPTOR_COPIES.append(_copy_file_range)
+if hasattr(os, "sendfile"):
+    _DESCRIPTOR_COPIES.append(_sendfile)
+
+# Errors meaning the files cannot be copied by that system call
+_UNSUPPORTED_COPY_ERRNOS = {
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+    errno.EBADF, errno.ESPIPE,
+}
 
 class CounterWriter(BufferedIOBase):
     def __init__(self, output):
@@ -66,30 +219,41 @@ class CounterWriter(BufferedIOBase):
         return self.length
 
 class TeeReader(Reader):
+    """Passes data read from a source on to write functions
+    
+    An empty write marks the end of the source. It is made when a read
+    asking for data gets none, and after reading everything at once."""
+    
     def __init__(self, source, *write):
         self._source = source
         self._write = write
     
     def read(self, *pos, **kw):
         result = self._source.read(*pos, **kw)
-        self._call_write(result)
+        [size] = pos or (kw.get("size", kw.get("amt")),)
+        end = size is None or size < 0 or size and not result
+        self._call_write(result, end)
         return result
     def read1(self, *pos, **kw):
         result = self._source.read1(*pos, **kw)
-        self._call_write(result)
+        [size] = pos or (kw.get("size", -1),)
+        self._call_write(result, size != 0 and not result)
         return result
     
     def readinto(self, b):
-        n = self._readinto(b)
+        n = self._source.readinto(b)
         with memoryview(b) as view, view.cast("B") as bytes:
-            self._call_write(bytes[:n])
+            self._call_write(bytes[:n], bytes and not n)
         return n
     def readinto1(self, b):
-        n = self._readinto(b)
+        n = self._source.readinto1(b)
         with memoryview(b) as view, view.cast("B") as bytes:
-            self._call_write(bytes[:n])
+            self._call_write(bytes[:n], bytes and not n)
         return n
     
-    def _call_write(self, b):
+    def _call_write(self, b, end):
         for write in self._write:
-            write(b)
+            if b:
+                write(b)
+            if end:
+                write(b[:0])
@@ -0,0 +1,483 @@
+from unittest import TestCase
+from io import StringIO
+from unittest.mock import patch
+from contextlib import closing
+from email.errors import MissingHeaderBodySeparatorDefect
+import asyncio
+import socket
+import threading
+import http.client
+from coroutines.http import (
+    HTTPConnection, Parser, Reader, BadRequestLine, AsyncClient, Pipeline,
+    Server)
+from coroutines.socket import Socket
+
+class LoopTest(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+    
+    def run_loop(self, coro):
+        return self.loop.run_until_complete(coro)
+    
+    def socketpair(self):
+        """Returns a coroutine Socket, and a blocking socket as its peer"""
+        [sock, peer] = socket.socketpair()
+        self.addCleanup(peer.close)
+        sock = Socket(fileno=sock.detach(), loop=self.loop)
+        self.addCleanup(sock.close)
+        return (sock, peer)
+    
+    def connection(self, data, *methods):
+        """Returns a connection receiving "data" and EOF"""
+        [sock, peer] = self.socketpair()
+        peer.sendall(data)
+        peer.shutdown(socket.SHUT_WR)
+        connection = HTTPConnection(sock)
+        connection._methods.extend(methods)
+        return connection
+    
+    def response(self, data, method="GET"):
+        """Parse a response received after sending "data" and EOF"""
+        connection = self.connection(data, method)
+        return self.run_loop(connection.getresponse())
+    
+    def read_all(self, response):
+        async def read():
+            body = bytearray()
+            while True:
+                data = await response.read(0x10000)
+                if not data:
+                    return bytes(body)
+                body.extend(data)
+        return self.run_loop(read())
+
+class TestParser(LoopTest):
+    def test_header(self):
+        response = self.response(
+            b"HTTP/1.1 200 OK\r\n"
+            b"A: 1\r\n"
+            b"Folded: x\r\n"
+            b"  y\r\n"
+            b"No colon\r\n"
+            b"B: 2\r\n"
+            b"Content-Length: 4\r\n"
+            b"\r\n"
+            b"body")
+        self.assertEqual(200, response.status)
+        self.assertEqual("OK", response.reason)
+        self.assertEqual(11, response.version)
+        self.assertEqual("x y", response.msg["Folded"])
+        self.assertEqual("2", response.msg["B"])
+        [defect] = response.msg.defects
+        self.assertIsInstance(defect, MissingHeaderBodySeparatorDefect)
+        self.assertEqual(b"body", self.read_all(response))
+    
+    def test_interim(self):
+        response = self.response(
+            b"HTTP/1.1 100 Continue\r\n\r\n"
+            b"HTTP/1.0 204 No Content\r\n\r\n")
+        self.assertEqual(204, response.status)
+        self.assertEqual(10, response.version)
+        self.assertEqual(b"", self.read_all(response))
+    
+    def test_bad_status(self):
+        with self.assertRaises(http.client.BadStatusLine):
+            self.response(b"junk\r\n\r\n")
+    
+    def test_buffered(self):
+        """Test data received after a response is kept for the next one"""
+        connection = self.connection(
+            b"HTTP/1.1 200 First\r\nContent-Length: 5\r\n\r\nfirst"
+            b"HTTP/1.1 200 Second\r\nContent-Length: 6\r\n\r\nsecond",
+            "GET", "GET")
+        for [reason, body] in (("First", b"first"), ("Second", b"second")):
+            response = self.run_loop(connection.getresponse())
+            self.assertEqual(reason, response.reason)
+            self.assertEqual(body, self.read_all(response))
+    
+    def test_request_line(self):
+        [sock, peer] = self.socketpair()
+        peer.sendall(b"GET /path?q HTTP/1.0\r\nrubbish\r\n")
+        parser = Parser(Reader(sock))
+        self.assertEqual(("GET", "/path?q", 10),
+            self.run_loop(parser.request_line()))
+        with self.assertRaises(BadRequestLine):
+            self.run_loop(parser.request_line())
+        peer.shutdown(socket.SHUT_WR)
+        with self.assertRaises(EOFError):
+            self.run_loop(parser.request_line())
+
+class TestBody(LoopTest):
+    def test_bad_length(self):
+        for length in (b"-4", b"+5", b"5 5", b"0x5"):
+            with self.subTest(length):
+                with self.assertRaises(http.client.HTTPException):
+                    self.response(b"HTTP/1.1 200 OK\r\n"
+                        b"Content-Length: " + length + b"\r\n\r\n"
+                        b"abcde")
+    
+    def test_head(self):
+        response = self.response(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Length: 10\r\n"
+            b"\r\n", "HEAD")
+        self.assertEqual(b"", self.read_all(response))
+    
+    def test_readinto(self):
+        [sock, peer] = self.socketpair()
+        peer.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc")
+        connection = HTTPConnection(sock)
+        response = self.run_loop(connection.getresponse())
+        buffer = bytearray(8)
+        # Buffered data is copied
+        self.assertEqual(3, self.run_loop(response.readinto(buffer)))
+        self.assertEqual(b"abc", buffer[:3])
+        # Then data is received directly, limited to the body
+        peer.sendall(b"defghijEXTRA")
+        self.assertEqual(7, self.run_loop(response.readinto(buffer)))
+        self.assertEqual(b"defghij", buffer[:7])
+        self.assertEqual(0, self.run_loop(response.readinto(buffer)))
+    
+    def test_length_truncated(self):
+        response = self.response(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Length: 10\r\n"
+            b"\r\n"
+            b"abc")
+        self.assertEqual(b"", self.run_loop(response.read(0)))
+        with self.assertRaises(http.client.IncompleteRead):
+            self.read_all(response)
+    
+    def test_chunked(self):
+        response = self.response(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"\r\n"
+            b"3;ext=1\r\nabc\r\n"
+            b"A\r\n0123456789\r\n"
+            b"0\r\n"
+            b"Trailer: value\r\n"
+            b"\r\n")
+        self.assertNotIn("Transfer-Encoding", response.msg)
+        self.assertEqual(b"ab", self.run_loop(response.read(2)))
+        buffer = bytearray(5)
+        self.assertEqual(5, self.run_loop(response.readinto(buffer)))
+        self.assertEqual(b"c0123", buffer)
+        self.assertEqual(b"456789", self.read_all(response))
+        self.assertEqual("value", response.trailers["Trailer"])
+    
+    def test_last_chunk(self):
+        """Test data is returned without waiting for the trailer"""
+        [sock, peer] = self.socketpair()
+        peer.sendall(b"HTTP/1.1 200 OK\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"\r\n"
+            b"3\r\nabc\r\n0\r\n")
+        response = self.run_loop(HTTPConnection(sock).getresponse())
+        read = asyncio.wait_for(response.read(100), 10)
+        self.assertEqual(b"abc", self.run_loop(read))
+        peer.sendall(b"Trailer: value\r\n\r\n")
+        self.assertEqual(b"", self.read_all(response))
+        self.assertEqual("value", response.trailers["Trailer"])
+    
+    def test_chunked_truncated(self):
+        for data in (b"3\r\nabc\r\n", b"3\r\nab", b"3\r\nabc\r\n1"):
+            with self.subTest(data):
+                response = self.response(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Transfer-Encoding: chunked\r\n"
+                    b"\r\n" + data)
+                with self.assertRaises(http.client.IncompleteRead):
+                    self.read_all(response)
+    
+    def test_chunk_size(self):
+        response = self.response(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"\r\n"
+            b"zz\r\nabc\r\n0\r\n\r\n")
+        with self.assertRaises(http.client.HTTPException):
+            self.read_all(response)
+
+class TestRequest(LoopTest):
+    class Socket:
+        """Records the writes made to it"""
+        
+        def __init__(self):
+            self.writes = list()
+        
+        async def sendall(self, data):
+            self.writes.append([bytes(data)])
+        
+        async def sendall_many(self, buffers):
+            self.writes.append([bytes(buffer) for buffer in buffers])
+    
+    def test_coalesce(self):
+        sock = self.Socket()
+        connection = HTTPConnection(sock)
+        large = b"x" * (HTTPConnection.BODY_COALESCE_LIMIT + 1)
+        async def send():
+            connection.putrequest("POST", "/a b")
+            connection.putheader("Content-Length", "5")
+            await connection.endheaders(b"small")
+            connection.putrequest("POST", "/")
+            await connection.endheaders(large)
+        self.run_loop(send())
+        header = b"POST / HTTP/1.1\r\n\r\n"
+        self.assertEqual([
+            [b"POST /a%20b HTTP/1.1\r\nContent-Length: 5\r\n\r\nsmall"],
+            [header, large],
+        ], sock.writes)
+
+class TestClient(LoopTest):
+    def setUp(self):
+        super().setUp()
+        self.client = AsyncClient(loop=self.loop)
+        self.addCleanup(self.client.close)
+    
+    def request(self, data, url="http://example/"):
+        """Send a request over an idle connection and return the response
+        
+        The server side receives the request, then "data" and EOF."""
+        
+        [sock, peer] = self.socketpair()
+        self.peer = peer
+        peer.sendall(data)
+        peer.shutdown(socket.SHUT_WR)
+        key = ("http", "example", 80)
+        self.client._idle[key] = [HTTPConnection(sock)]
+        return self.run_loop(self.client.get(url))
+    
+    def idle(self):
+        return self.client._idle[("http", "example", 80)]
+    
+    def test_reuse(self):
+        response = self.request(
+            b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc",
+            "http://example/path?q#fragment")
+        with response:
+            self.assertEqual(b"", self.run_loop(response.read(0)))
+            self.assertEqual([], self.idle())
+            self.assertEqual(b"abc", self.run_loop(response.read()))
+            self.assertEqual(1, len(self.idle()))
+        request = self.peer.recv(1000)
+        self.assertTrue(request.startswith(b"GET /path?q HTTP/1.1\r\n"))
+    
+    def test_truncated(self):
+        response = self.request(
+            b"HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nabc")
+        with response, self.assertRaises(http.client.IncompleteRead):
+            self.run_loop(response.read())
+        self.assertEqual([], self.idle())
+    
+    def test_readinto(self):
+        response = self.request(
+            b"HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc")
+        with response:
+            self.assertEqual(0,
+                self.run_loop(response.readinto(bytearray())))
+            self.assertEqual([], self.idle())
+            buffer = bytearray(10)
+            self.assertEqual(3, self.run_loop(response.readinto(buffer)))
+            self.assertEqual(b"abc", buffer[:3])
+            self.assertEqual(1, len(self.idle()))
+    
+    def test_chunked(self):
+        response = self.request(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Transfer-Encoding: chunked\r\n"
+            b"\r\n"
+            b"3\r\nabc\r\n"
+            b"0\r\nTrailer: value\r\n\r\n")
+        with response:
+            self.assertEqual(b"abc", self.run_loop(response.read(3)))
+            self.assertEqual([], self.idle())
+            self.assertEqual(b"", self.run_loop(response.read(3)))
+            self.assertEqual("value", response.trailers["Trailer"])
+            self.assertEqual(1, len(self.idle()))
+
+class TestSocket(LoopTest):
+    def test_sendall(self):
+        """Test data is sent completely despite partial writes"""
+        [sock, peer] = self.socketpair()
+        sock.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 0x1000)
+        data = bytes(range(256)) * 0x1000
+        received = bytearray()
+        def receive():
+            while len(received) < 3 * len(data):
+                chunk = peer.recv(0x10000)
+                if not chunk:
+                    break
+                received.extend(chunk)
+        thread = threading.Thread(target=receive)
+        thread.start()
+        try:
+            self.run_loop(sock.sendall(data))
+            self.run_loop(sock.sendall_many((data, memoryview(data))))
+        finally:
+            sock.close()
+            thread.join()
+        self.assertEqual(data * 3, received)
+
+class TestPipeline(LoopTest):
+    def test_replay(self):
+        """Test unanswered requests are sent again on a new connection"""
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        
+        self.connections = 0
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def do_GET(handler):
+                handler.answered += 1
+                body = handler.path.encode("ascii")
+                handler.send_response(200)
+                handler.send_header("Content-Length", format(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+                if handler.answered >= 2:
+                    handler.close_connection = True
+            
+            def handle(handler):
+                self.connections += 1
+                handler.answered = 0
+                return BaseHTTPRequestHandler.handle(handler)
+            
+            def log_message(*pos, **kw):
+                pass
+        
+        server = ThreadingHTTPServer(("localhost", 0), RequestHandler)
+        self.addCleanup(server.server_close)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        
+        async def connect():
+            sock = Socket(socket.AF_INET, loop=self.loop)
+            try:
+                await sock.connect(server.server_address)
+            except:
+                sock.close()
+                raise
+            return HTTPConnection(sock)
+        
+        async def run():
+            with Pipeline(connect) as pipeline:
+                for i in range(5):
+                    await pipeline.request("GET", "/{}".format(i),
+                        (("Host", "localhost"),))
+                bodies = list()
+                for _ in range(5):
+                    response = await pipeline.getresponse()
+                    bodies.append(await response.read(100))
+                with self.assertRaises(ValueError):
+                    await pipeline.request("POST", "/")
+                return bodies
+        expected = ["/{}".format(i).encode() for i in range(5)]
+        self.assertEqual(expected, self.run_loop(run()))
+        self.assertEqual(3, self.connections)
+
+class TestServer(LoopTest):
+    def setUp(self):
+        super().setUp()
+        async def handler(request):
+            body = await request.read()
+            if request.target == "/error":
+                raise ValueError("Handler failure")
+            body = b" ".join((request.method.encode(),
+                request.target.encode(), body))
+            return (200, [("Content-Type", "text/plain")], body)
+        self.server = Server(handler, ("localhost", 0), loop=self.loop)
+        self.addCleanup(self.server.close)
+        self.port = self.server.server_address[1]
+        
+        stderr = patch("sys.stderr", StringIO())
+        self.stderr = stderr.start()
+        self.addCleanup(stderr.stop)
+    
+    def client(self, func):
+        """Run "func" in a thread while the server is running"""
+        serving = self.loop.create_task(self.server.serve_forever())
+        try:
+            return self.run_loop(self.loop.run_in_executor(None, func))
+        finally:
+            serving.cancel()
+            try:
+                self.run_loop(serving)
+            except asyncio.CancelledError:
+                pass
+    
+    def test_keep_alive(self):
+        def client():
+            connection = http.client.HTTPConnection("localhost", self.port)
+            with closing(connection):
+                connection.request("POST", "/one", b"body")
+                response = connection.getresponse()
+                result = [response.read()]
+                sock = connection.sock
+                connection.request("POST", "/two",
+                    iter((b"chunk1", b"chunk2")), encode_chunked=True)
+                result.append(connection.getresponse().read())
+                connection.request("HEAD", "/three")
+                response = connection.getresponse()
+                result.append(response.getheader("Content-Length"))
+                result.append(response.read())
+                result.append(connection.sock is sock)
+                return result
+        self.assertEqual([b"POST /one body", b"POST /two chunk1chunk2",
+            "12", b"", True], self.client(client))
+    
+    def test_bad_request(self):
+        def client():
+            with socket.create_connection(("localhost", self.port)) as sock:
+                sock.sendall(b"garbage\r\n\r\n")
+                with sock.makefile("rb") as response:
+                    return response.read()
+        response = self.client(client)
+        self.assertTrue(response.startswith(b"HTTP/1.1 400 "))
+        self.assertIn(b"\r\nConnection: close\r\n", response)
+    
+    def test_bad_length(self):
+        def client():
+            with socket.create_connection(("localhost", self.port)) as sock:
+                sock.sendall(b"POST / HTTP/1.1\r\n"
+                    b"Content-Length: -4\r\n\r\n"
+                    b"GET / HTTP/1.1\r\n\r\n")
+                with sock.makefile("rb") as response:
+                    return response.read()
+        response = self.client(client)
+        self.assertTrue(response.startswith(b"HTTP/1.1 400 "))
+        self.assertNotIn(b"HTTP/1.1 200 ", response)
+        self.assertEqual("", self.stderr.getvalue())
+    
+    def test_accept_error(self):
+        """Test the server keeps accepting after running out of files"""
+        from errno import EMFILE
+        accept = self.server.sock.accept
+        errors = [OSError(EMFILE, "Too many open files")]
+        async def failing_accept():
+            if errors:
+                raise errors.pop()
+            return await accept()
+        self.server.sock.accept = failing_accept
+        def client():
+            connection = http.client.HTTPConnection("localhost", self.port,
+                timeout=10)
+            with closing(connection):
+                connection.request("GET", "/")
+                return connection.getresponse().read()
+        self.assertEqual(b"GET / ", self.client(client))
+        self.assertIn("Too many open files", self.stderr.getvalue())
+    
+    def test_error(self):
+        def client():
+            connection = http.client.HTTPConnection("localhost", self.port)
+            with closing(connection):
+                connection.request("GET", "/error")
+                response = connection.getresponse()
+                return (response.status, response.getheader("Connection"),
+                    response.read())
+        self.assertEqual((500, "close", b""), self.client(client))
+        self.assertIn("Handler failure", self.stderr.getvalue())
@@ -1,8 +1,11 @@
 #! /usr/bin/env python3
 
 from unittest import TestCase
-from io import BytesIO, BufferedReader
+from io import BytesIO, BufferedReader, StringIO
 from errno import ECONNREFUSED
+import time
+import os
+import hashlib
 import net
 import urllib.request
 import http.client
@@ -21,6 +24,61 @@ class Test(TestCase):
             with self.subTest(input):
                 self.assertEqual(output, net.format_addr(input))
 
+    def test_parse_addr(self):
+        self.assertEqual([("::1", 80), ("example", None), ("", 8080)],
+            net.parse_addrs(["[::1]:80", "EXAMPLE", ":8080"]))
+        self.assertEqual(["[::1]:80", "example"],
+            net.format_addrs([("::1", 80), ("example", None)]))
+        for address in ("[::1", "[127.0.0.1]", "host:port", "host:70000"):
+            with self.subTest(address), self.assertRaises(ValueError):
+                net.parse_addr(address)
+    
+    def test_parse_urls(self):
+        urls = ("HTTP://User:pw@Example.COM:80/a?b#c", "localhost:8080/",
+            "https://[::1]?", "//example")
+        results = (
+            ("http", "User", "pw", "example.com", 80, "/a?b#c",
+                "http://User:pw@example.com/a?b#c"),
+            ("http", None, None, "localhost", 8080, "/",
+                "http://localhost:8080/"),
+            ("https", None, None, "::1", 443, "", "https://[::1]"),
+            ("http", None, None, "example", 80, "", "http://example"),
+        )
+        for [url, expected] in zip(net.parse_urls(urls), results):
+            with self.subTest(expected[-1]):
+                self.assertEqual(expected, (url.scheme, url.username,
+                    url.password, url.hostname, url.port, url.path,
+                    url.normalized()))
+        for url in ("http://[127.0.0.1]/", "http://[::1/", "ftp://host"):
+            with self.subTest(url), self.assertRaises(ValueError):
+                list(net.parse_urls([url]))
+    
+    def test_header_split(self):
+        header = r'a, "b, \"c\"", d; e="f, g", "h'
+        self.assertEqual(['a', r'"b, \"c\""', 'd; e="f, g"', '"h'],
+            list(net.header_split(header, ",")))
+    
+    def test_header_params_list(self):
+        msg = http.client.HTTPMessage()
+        msg["Accept"] = 'text/html; q=0.9, */*; Q="0.1"'
+        self.assertEqual([("text/html", {"q": ("0.9",)}),
+            ("*/*", {"q": ('"0.1"',)})],
+            list(net.header_params_list(msg, "Accept")))
+    
+    def test_header_cache(self):
+        msg = http.client.HTTPMessage()
+        msg["Content-Encoding"] = "gzip, identity"
+        with patch("net.header_cache", net.HeaderCache(max_entries=1)):
+            for _ in range(2):
+                self.assertEqual(["gzip", "identity"],
+                    list(net.header_list(msg, "Content-Encoding")))
+            params = net.header_params("charset=utf-8")
+            self.assertIs(params, net.header_params("charset=utf-8"))
+            with self.assertRaises(TypeError):
+                params["charset"] = ("latin-1",)
+            self.assertEqual({"hits": 2, "misses": 2, "evictions": 1},
+                net.header_cache.stats)
+
 class TestPersistentHttp(TestCase):
     def setUp(self):
         TestCase.setUp(self)
@@ -108,6 +166,407 @@ class TestLoopbackHttp(TestPersistentHttp):
             self.urlopen(self.url + "/close-if-reused", data)
         self.assertEqual(1, self.handle_calls, "Server handle() retried")
 
+class TestFetchMany(TestCase):
+    def setUp(self):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        from threading import Thread, Lock
+        
+        self.handle_calls = 0
+        lock = Lock()
+        class RequestHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def do_GET(handler):
+                body = handler.path.encode("ascii")
+                handler.send_response(200)
+                handler.send_header("Content-Length", format(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+            
+            def handle(handler, *pos, **kw):
+                with lock:
+                    self.handle_calls += 1
+                return BaseHTTPRequestHandler.handle(handler, *pos, **kw)
+            
+            def log_message(*pos, **kw):
+                pass
+        
+        server = ThreadingHTTPServer(("localhost", 0), RequestHandler)
+        self.addCleanup(server.server_close)
+        self.url = "http://localhost:{}".format(server.server_port)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+    
+    def test_fetch(self):
+        """Test all URLs are fetched over a few reused connections"""
+        urls = ["{}/{}".format(self.url, i) for i in range(20)]
+        results = dict()
+        for [url, response, body] in net.fetch_many(urls, workers=3):
+            self.assertEqual(200, response.status)
+            results[url] = body
+        expected = {url: url[len(self.url):].encode() for url in urls}
+        self.assertEqual(expected, results)
+        self.assertLessEqual(self.handle_calls, 3)
+    
+    def test_window(self):
+        """Test URLs are only taken as results are consumed"""
+        taken = list()
+        def urls():
+            for i in range(20):
+                url = "{}/{}".format(self.url, i)
+                taken.append(url)
+                yield url
+        results = net.fetch_many(urls(), workers=3)
+        next(results)
+        self.assertEqual(6, len(taken))
+        self.assertEqual(19, len(list(results)))
+
+class TestPooledServer(TestCase):
+    def test_concurrent(self):
+        from socketserver import TCPServer, StreamRequestHandler
+        from threading import Thread, Barrier
+        import socket
+        
+        barrier = Barrier(3, timeout=10)
+        handled = list()
+        class Handler(StreamRequestHandler):
+            def handle(handler):
+                line = handler.rfile.readline()
+                barrier.wait()
+                time.sleep(0.1)
+                handler.wfile.write(line)
+                handled.append(line)
+        
+        class PooledServer(net.PooledServer, TCPServer):
+            pass
+        server = PooledServer(("localhost", 0), Handler, max_workers=3)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            clients = list()
+            for i in range(3):
+                client = socket.create_connection(server.server_address)
+                self.addCleanup(client.close)
+                client.sendall(b"%d\n" % i)
+                clients.append(client)
+            for [i, client] in enumerate(clients):
+                self.assertEqual(b"%d\n" % i, client.recv(100))
+        finally:
+            server.shutdown()
+            thread.join()
+        
+        client = socket.create_connection(server.server_address)
+        self.addCleanup(client.close)
+        client.sendall(b"drained\n")
+        barrier = Barrier(1)
+        server.handle_request()
+        server.close()  # Should wait for the request to finish
+        self.assertEqual(b"drained\n", handled[-1])
+
+class TestRequestCached(TestCase):
+    def setUp(self):
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+        from threading import Thread
+        from tempfile import TemporaryDirectory
+        
+        self.requests = list()
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                self.requests.append((handler.path,
+                    handler.headers["If-None-Match"]))
+                if handler.headers["If-None-Match"] == '"v1"':
+                    handler.send_response(304)
+                    handler.send_header("Cache-Control", "max-age=1000")
+                    handler.send_header("Connection", "keep-alive, X-Hop")
+                    handler.send_header("Keep-Alive", "timeout=5")
+                    handler.send_header("X-Hop", "1")
+                    handler.end_headers()
+                    return
+                if handler.path == "/slow":
+                    time.sleep(0.2)
+                if handler.path == "/chunked":
+                    handler.send_response(200)
+                    handler.send_header("Transfer-Encoding", "chunked")
+                    handler.end_headers()
+                    handler.wfile.write(b"5\r\nhello\r\n0\r\n\r\n")
+                    return
+                body = b"body of " + handler.path.encode("ascii")
+                if handler.path.startswith("/same/"):
+                    body = b"same body"
+                if handler.path == "/large":
+                    body = bytes(100000)
+                handler.send_response(200)
+                handler.send_header("Content-Length", format(len(body)))
+                if handler.path == "/etag":
+                    handler.send_header("ETag", '"v1"')
+                    handler.send_header("Cache-Control", "max-age=0")
+                if handler.path == "/no-store":
+                    handler.send_header("Cache-Control", "no-store")
+                handler.end_headers()
+                handler.wfile.write(body)
+            
+            def log_message(*pos, **kw):
+                pass
+        
+        server = HTTPServer(("localhost", 0), RequestHandler)
+        self.addCleanup(server.server_close)
+        self.url = "http://localhost:{}".format(server.server_port)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        
+        dir = TemporaryDirectory()
+        self.addCleanup(dir.cleanup)
+        self.cache = net.HttpCache(dir.name)
+        self.addCleanup(self.cache.close)
+        
+        stderr = patch("sys.stderr", StringIO())
+        stderr.start()
+        self.addCleanup(stderr.stop)
+    
+    def request(self, path):
+        from contextlib import ExitStack
+        with ExitStack() as cleanup:
+            [header, response] = net.request_cached(self.url + path,
+                cache=self.cache, cleanup=cleanup)
+            return (header, response.read())
+    
+    def test_hit(self):
+        for _ in range(2):
+            [header, body] = self.request("/plain")
+            self.assertEqual(b"body of /plain", body)
+            self.assertEqual("200 OK", header["Status"])
+        self.assertEqual([("/plain", None)], self.requests)
+    
+    def test_stored_before_fill(self):
+        """Test an entry stored after the first lookup is used"""
+        fill = self.cache.fill
+        def racing_fill(key):
+            # Another caller stores the response before the claim
+            self.cache.fill = fill
+            self.request("/plain")
+            return fill(key)
+        self.cache.fill = racing_fill
+        [header, body] = self.request("/plain")
+        self.assertEqual(b"body of /plain", body)
+        self.assertEqual([("/plain", None)], self.requests)
+    
+    def test_chunked(self):
+        for _ in range(2):
+            [header, body] = self.request("/chunked")
+            self.assertEqual(b"hello", body)
+        self.assertEqual([("/chunked", None)], self.requests)
+        self.assertEqual(0, self.cache.stats["incomplete"])
+    
+    def test_chunked_partial(self):
+        """Test a partly read chunked body is not stored"""
+        from contextlib import ExitStack
+        with ExitStack() as cleanup:
+            [header, response] = net.request_cached(self.url + "/chunked",
+                cache=self.cache, cleanup=cleanup)
+            self.assertEqual(b"", response.read(0))
+            self.assertEqual(b"hel", response.read(3))
+        self.assertEqual(1, self.cache.stats["incomplete"])
+        [header, body] = self.request("/chunked")
+        self.assertEqual(b"hello", body)
+        self.assertEqual(2, len(self.requests))
+    
+    def test_incomplete(self):
+        from contextlib import ExitStack
+        with ExitStack() as cleanup:
+            [header, response] = net.request_cached(self.url + "/plain",
+                cache=self.cache, cleanup=cleanup)
+            self.assertEqual(b"body", response.read(4))
+        self.assertIsNone(self.cache.lookup(self.cache_key("/plain")))
+        [header, body] = self.request("/plain")
+        self.assertEqual(b"body of /plain", body)
+        self.assertEqual(2, len(self.requests))
+        for [dir, dirs, files] in os.walk(self.cache.root):
+            for name in files:
+                self.assertFalse(name.endswith(self.cache.TEMP_SUFFIX))
+    
+    def test_sweep(self):
+        """Test abandoned files are removed without walking the root"""
+        old = time.time() - self.cache.fill_timeout - 1
+        paths = list()
+        for dir in (self.cache.TEMPS, self.cache.LOCKS, "other"):
+            path = self.cache.path(os.path.join(dir,
+                "abandoned" + self.cache.TEMP_SUFFIX))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, "wb").close()
+            os.utime(path, (old, old))
+            paths.append(path)
+        self.cache.sweep()
+        self.assertEqual([False, False, True],
+            list(map(os.path.exists, paths)))
+        self.assertEqual(2, self.cache.stats["swept"])
+    
+    def test_codecs(self):
+        from tempfile import TemporaryDirectory
+        for codec in net.HttpCache.CODECS:
+            with self.subTest(codec), TemporaryDirectory() as dir:
+                self.cache = net.HttpCache(dir, codec=codec)
+                with self.cache:
+                    for _ in range(2):
+                        [header, body] = self.request("/" + codec)
+                        self.assertEqual(b"body of /" + codec.encode(),
+                            body)
+                    entry = self.cache.lookup(self.cache_key("/" + codec))
+                    self.assertEqual(codec, entry.codec)
+                    with open(self.cache.path(entry.body), "rb") as file:
+                        self.assertNotEqual(body, file.read())
+        self.assertEqual(len(net.HttpCache.CODECS), len(self.requests))
+    
+    def test_dedup(self):
+        self.cache.dedup = True
+        for path in ("/same/1", "/same/2", "/same/1", "/same/2"):
+            [header, body] = self.request(path)
+            self.assertEqual(b"same body", body)
+        self.assertEqual(2, len(self.requests))
+        entries = [self.cache.lookup(self.cache_key(path))
+            for path in ("/same/1", "/same/2")]
+        self.assertEqual(entries[0].body, entries[1].body)
+        self.cache._remove(self.cache_key("/same/1"))
+        self.assertTrue(os.path.exists(self.cache.path(entries[1].body)))
+        self.cache._remove(self.cache_key("/same/2"))
+        self.assertFalse(os.path.exists(self.cache.path(entries[1].body)))
+    
+    def test_send_body(self):
+        import socket
+        self.request("/plain")
+        entry = self.cache.lookup(self.cache_key("/plain"))
+        [a, b] = socket.socketpair()
+        with a, b:
+            self.assertEqual(14, self.cache.send_body(
+                self.cache_key("/plain"), entry, a))
+            self.assertEqual(7, net.send_file(a, BytesIO(b"BytesIO")))
+            self.assertEqual(b"body of /plainBytesIO", b.recv(100))
+    
+    def test_send_compressed(self):
+        import socket
+        from tempfile import TemporaryDirectory
+        for codec in net.HttpCache.CODECS:
+            with self.subTest(codec), TemporaryDirectory() as dir:
+                self.cache = net.HttpCache(dir, codec=codec)
+                with self.cache:
+                    self.request("/" + codec)
+                    key = self.cache_key("/" + codec)
+                    entry = self.cache.lookup(key)
+                    [a, b] = socket.socketpair()
+                    with a, b:
+                        body = b"body of /" + codec.encode()
+                        self.assertEqual(len(body),
+                            self.cache.send_body(key, entry, a))
+                        self.assertEqual(body, b.recv(100))
+    
+    def cache_key(self, path):
+        return hashlib.md5((self.url + path).encode("ascii")).hexdigest()
+    
+    def test_concurrent(self):
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(3) as executor:
+            results = list(executor.map(self.request, ["/slow"] * 3))
+        for [header, body] in results:
+            self.assertEqual(b"body of /slow", body)
+        self.assertEqual([("/slow", None)], self.requests)
+    
+    def test_memory(self):
+        """Test memory tier serves repeated hits"""
+        self.cache.memory_entries = 10
+        for _ in range(3):
+            [header, body] = self.request("/plain")
+            self.assertEqual(b"body of /plain", body)
+            self.assertEqual("200 OK", header["Status"])
+        self.assertEqual(1, self.cache.stats["memory_hits"])
+        self.assertEqual(2, self.cache.stats["memory_misses"])
+        self.assertEqual(1, self.cache.stats["hits"])
+    
+    def test_memory_compressed(self):
+        """Test the memory limit applies to the decompressed size"""
+        from tempfile import TemporaryDirectory
+        with TemporaryDirectory() as dir:
+            self.cache = net.HttpCache(dir, codec="zlib", memory_entries=10,
+                memory_body_limit=1000)
+            with self.cache:
+                for _ in range(2):
+                    [header, body] = self.request("/large")
+                    self.assertEqual(bytes(100000), body)
+                key = self.cache_key("/large")
+                self.assertLess(self.cache.lookup(key).size, 1000)
+                self.assertIsNone(self.cache._memory[key].body)
+    
+    def test_revalidate(self):
+        """Test stale response is revalidated with its ETag"""
+        for _ in range(3):
+            [header, body] = self.request("/etag")
+            self.assertEqual(b"body of /etag", body)
+        self.assertEqual("max-age=1000", header["Cache-Control"])
+        for field in ("Connection", "Keep-Alive", "X-Hop"):
+            self.assertNotIn(field, header)
+        expected = [("/etag", None), ("/etag", '"v1"')]
+        self.assertEqual(expected, self.requests)
+    
+    def test_no_store(self):
+        for _ in range(2):
+            [_, body] = self.request("/no-store")
+            self.assertEqual(b"body of /no-store", body)
+        self.assertEqual(2, len(self.requests))
+    
+    def test_evict(self):
+        """Test least recently used body is removed"""
+        self.cache.max_size = 30
+        self.request("/one")
+        self.request("/two")
+        self.request("/one")
+        self.request("/three")  # Should evict "/two"
+        self.request("/one")
+        self.request("/two")
+        paths = [path for [path, _] in self.requests]
+        self.assertEqual(["/one", "/two", "/three", "/two"], paths)
+
+class TestDefaultCache(TestCase):
+    def test_close_at_exit(self):
+        from tempfile import TemporaryDirectory
+        with TemporaryDirectory() as dir, patch("os.curdir", dir):
+            with patch("atexit.register") as register:
+                cache = net.default_cache()
+            try:
+                self.assertIs(cache, net.default_cache())
+                register.assert_called_once_with(cache.close)
+            finally:
+                cache.close()
+                del net._default_caches[os.path.abspath(dir)]
+
+class TestDecoding(TestCase):
+    def decode(self, body, *encodings):
+        header = http.client.HTTPMessage()
+        for encoding in encodings:
+            header["Content-Encoding"] = encoding
+        with patch("net.request_cached", return_value=(header, body)):
+            [header, response] = net.request_decoded("url")
+        return response.read()
+    
+    def test_stacked(self):
+        import gzip, zlib
+        body = zlib.compress(gzip.compress(b"data"))
+        self.assertEqual(b"data", self.decode(BytesIO(body),
+            "gzip", "identity, deflate"))
+    
+    def test_raw_deflate(self):
+        import zlib
+        compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        body = compressor.compress(b"data") + compressor.flush()
+        self.assertEqual(b"data", self.decode(BytesIO(body), "deflate"))
+    
+    def test_gzip_members(self):
+        import gzip
+        body = gzip.compress(b"first ") + gzip.compress(b"second")
+        self.assertEqual(b"first second",
+            self.decode(BytesIO(body), "x-gzip"))
+
 class TestMockHttp(TestPersistentHttp):
     def setUp(self):
         super().setUp()
@@ -173,6 +632,53 @@ class TestHttpSocket(TestMockHttp):
         self.assertIsNot(sock1, sock2, "Expected new socket connection")
         self.assertTrue(sock2.reader, "Disconnected after second request")
 
+@patch("net.select", select_timeout)
+class TestPooledHttp(TestHttpSocket):
+    def setUp(self):
+        self.handler = net.PooledConnectionHandler(max_per_host=1)
+        self.addCleanup(self.handler.close)
+        self.urlopen = urllib.request.build_opener(self.handler).open
+        
+        entry = {"mock": self.HTTPConnection}
+        patcher = patch.dict(self.handler.conn_classes, entry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+    
+    def test_alternate_hosts(self):
+        """Test connections to two hosts are both kept open"""
+        with self.urlopen("mock://localhost/one") as response:
+            self.assertEqual(b"First body\r\n", response.read())
+        sock1 = self.handler._connection.sock
+        
+        with self.urlopen("mock://otherhost/two") as response:
+            self.assertEqual(b"First body\r\n", response.read())
+        sock2 = self.handler._connection.sock
+        self.assertIsNot(sock1, sock2, "Expected new socket connection")
+        
+        with self.urlopen("mock://LocalHost:80/three") as response:
+            self.assertEqual(b"Second body\r\n", response.read())
+        self.assertIs(sock1, self.handler._connection.sock,
+            "Expected first socket to be reused")
+        self.assertTrue(sock2.reader, "Idle connection closed")
+    
+    def test_max_per_host(self):
+        """Test an unfinished response holds its connection"""
+        with self.urlopen("mock://localhost/one"):
+            with self.assertRaises(http.client.CannotSendRequest):
+                self.urlopen("mock://localhost/two")
+    
+    def test_max_idle(self):
+        """Test least recently used connection is closed"""
+        self.handler.max_idle = 1
+        with self.urlopen("mock://localhost/one") as response:
+            response.read()
+        sock1 = self.handler._connection.sock
+        with self.urlopen("mock://otherhost/two") as response:
+            response.read()
+        with self.urlopen("mock://otherhost/three") as response:
+            self.assertEqual(b"Second body\r\n", response.read())
+        self.assertIsNone(sock1.data, "Excess idle connection not closed")
+
 class TestHttpEstablishError(TestMockHttp):
     """Connection establishment errors should not trigger a retry"""
     class HTTPConnection(http.client.HTTPConnection):
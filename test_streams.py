@@ -0,0 +1,151 @@
+from unittest import TestCase
+from unittest.mock import patch
+from io import BytesIO, BufferedIOBase
+from tempfile import TemporaryFile
+import socket
+import threading
+import streams
+from streams import streamcopy, pump, CounterWriter
+
+DATA = bytes(range(256)) * 1000
+
+class Writer(BufferedIOBase):
+    """Records each write"""
+    
+    def __init__(self):
+        self.writes = list()
+        self.buffers = set()
+    
+    def writable(self):
+        return True
+    
+    def write(self, b):
+        with memoryview(b) as view:
+            self.writes.append(view.tobytes())
+            if view.obj is not None:
+                self.buffers.add(id(view.obj))
+            return view.nbytes
+
+class TestStreamcopy(TestCase):
+    def test_buffer(self):
+        """Test a reused buffer of the block size is written"""
+        output = Writer()
+        progress = list()
+        streamcopy(BytesIO(DATA), output, 2500, block=1000,
+            on_progress=progress.append)
+        self.assertEqual([1000, 1000, 500], list(map(len, output.writes)))
+        self.assertEqual(DATA[:2500], b"".join(output.writes))
+        self.assertEqual(1, len(output.buffers))
+        self.assertEqual([1000, 2000, 2500], progress)
+    
+    def test_eof(self):
+        output = Writer()
+        with self.assertRaises(EOFError):
+            streamcopy(BytesIO(b"short"), output, 10)
+        self.assertEqual(b"short", b"".join(output.writes))
+        with self.assertRaises(ValueError):
+            streamcopy(BytesIO(), output, -1)
+    
+    def test_files(self):
+        """Test copying between files with buffered data at both ends"""
+        with TemporaryFile() as input, TemporaryFile() as output:
+            input.write(DATA)
+            input.seek(0)
+            self.assertEqual(DATA[:10], input.read(10))  # Fills buffer
+            output.write(b"start")  # Left in the buffer
+            progress = list()
+            streamcopy(input, output, 100000, on_progress=progress.append)
+            self.assertEqual(100010, input.tell())
+            self.assertEqual(DATA[100010:100020], input.read(10))
+            self.assertEqual(100005, output.tell())
+            output.write(b"end")
+            output.seek(0)
+            self.assertEqual(b"start" + DATA[10:100010] + b"end",
+                output.read())
+            self.assertEqual(100000, progress[-1])
+    
+    def test_file_eof(self):
+        with TemporaryFile() as input, TemporaryFile() as output:
+            input.write(DATA[:1000])
+            input.seek(100)
+            with self.assertRaises(EOFError):
+                streamcopy(input, output, 1000)
+            self.assertEqual(1000, input.tell())
+            output.seek(0)
+            self.assertEqual(DATA[100:1000], output.read())
+    
+    def test_socket_timeout(self):
+        """Test sending to a socket whose descriptor is non-blocking"""
+        length = 0x2000000
+        [sock, peer] = socket.socketpair()
+        with sock, peer, TemporaryFile() as input:
+            input.truncate(length)
+            sock.settimeout(10)
+            received = list()
+            def receive():
+                total = 0
+                while total < length:
+                    data = peer.recv(0x10000)
+                    if not data:
+                        break
+                    total += len(data)
+                received.append(total)
+            thread = threading.Thread(target=receive)
+            thread.start()
+            try:
+                with sock.makefile("wb") as output:
+                    streamcopy(input, output, length)
+            finally:
+                sock.shutdown(socket.SHUT_WR)
+                thread.join()
+            self.assertEqual([length], received)
+    
+    def test_socket_timeout_expired(self):
+        """Test the socket's timeout applies while the peer is not reading"""
+        [sock, peer] = socket.socketpair()
+        with sock, peer, TemporaryFile() as input:
+            input.truncate(0x2000000)
+            sock.settimeout(0.1)
+            with sock.makefile("wb") as output:
+                with self.assertRaises(TimeoutError):
+                    streamcopy(input, output, 0x2000000)
+
+class TestPump(TestCase):
+    def test_length(self):
+        output = Writer()
+        result = pump(BytesIO(DATA), output, length=2500, block=1000)
+        self.assertEqual(2500, result.copied)
+        self.assertEqual(DATA[:2500], b"".join(output.writes))
+        self.assertGreaterEqual(result.elapsed, 0)
+        if result.elapsed:
+            self.assertEqual(2500 / result.elapsed, result.rate)
+    
+    def test_eof(self):
+        progress = list()
+        output = Writer()
+        result = pump(BytesIO(DATA), output, block=100000,
+            on_progress=progress.append)
+        self.assertEqual(len(DATA), result.copied)
+        self.assertEqual(DATA, b"".join(output.writes))
+        self.assertEqual([100000, 200000, len(DATA)], progress)
+        
+        result = pump(BytesIO(b"short"), output, length=10)
+        self.assertEqual(5, result.copied)
+        with self.assertRaises(ValueError):
+            pump(BytesIO(), output, length=-1)
+    
+    def test_counter(self):
+        """Test a CounterWriter is bypassed so that descriptors are used"""
+        with TemporaryFile() as input, TemporaryFile() as file:
+            input.write(DATA)
+            input.seek(0)
+            output = CounterWriter(file)
+            output.write(b"start")
+            with patch("streams._copy_descriptors",
+                    wraps=streams._copy_descriptors) as copy:
+                result = pump(input, output)
+            self.assertIs(file, copy.call_args[0][1])
+            self.assertEqual(len(DATA), result.copied)
+            self.assertEqual(5 + len(DATA), output.tell())
+            file.seek(0)
+            self.assertEqual(b"start" + DATA, file.read())